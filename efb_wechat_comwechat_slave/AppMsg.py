@@ -0,0 +1,113 @@
+from typing import Optional
+
+from lxml import etree
+
+# AppMsg 之外的低频字段，预编译后按需求值
+XPATH_ITEMS = etree.XPath('//item')
+XPATH_PUBLISHER_NICKNAME = etree.XPath('//publisher/nickname/text()')
+XPATH_SPORT_RANK = etree.XPath('/msg/appmsg/hardwareinfo/messagenodeinfo/rankinfo/rank/rankdisplay/text()')
+XPATH_SPORT_SCORE = etree.XPath('/msg/appmsg/hardwareinfo/messagenodeinfo/rankinfo/score/scoredisplay/text()')
+XPATH_WEAPP_ICON_URL = etree.XPath('/msg/appmsg/weappinfo/weappiconurl/text()')
+XPATH_FINDER_FEED_AVATAR = etree.XPath('/msg/appmsg/finderFeed/avatar/text()')
+XPATH_FINDER_FEED_DESC = etree.XPath('/msg/appmsg/finderFeed/desc/text()')
+XPATH_FINDER_LIVE_HEAD_URL = etree.XPath('/msg/appmsg/finderLive/headUrl/text()')
+XPATH_FINDER_LIVE_DESC = etree.XPath('/msg/appmsg/finderLive/desc/text()')
+XPATH_PAY_SUBTYPE = etree.XPath('/msg/appmsg/wcpayinfo/paysubtype/text()')
+XPATH_PAY_FEEDESC = etree.XPath('/msg/appmsg/wcpayinfo/feedesc/text()')
+XPATH_RECORD_DATADESC = etree.XPath('/recordinfo/datalist/dataitem/datadesc/text()')
+
+
+def first(xpath: etree.XPath, xml) -> Optional[str]:
+    """
+    :return: xpath 的第一个结果，没有结果时返回 None
+    """
+    result = xpath(xml)
+    return result[0] if result else None
+
+
+def required(value):
+    """
+    与 xpath(...)[0] 一致，字段缺失时抛出 IndexError
+    """
+    if value is None:
+        raise IndexError("required field is missing")
+    return value
+
+
+def _to_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ReferMsg:
+    """
+    /msg/appmsg/refermsg，被引用的消息
+    """
+    __slots__ = ("type", "svrid", "fromusr", "chatusr", "displayname", "content")
+
+    def __init__(self):
+        self.type: Optional[int] = None
+        self.svrid: Optional[str] = None
+        self.fromusr: Optional[str] = None
+        self.chatusr: Optional[str] = None
+        self.displayname: Optional[str] = None
+        self.content: Optional[str] = None
+
+
+class AppMsg:
+    """
+    msgType 49 复合 xml 中的常用字段，遍历一次 /msg/appmsg 和 /msg/appinfo 的子节点填充
+    缺失的字段为 None；同名节点以第一个为准，与 xpath(...)[0] 一致
+    """
+    __slots__ = ("xml", "type", "title", "des", "url", "thumburl", "showtype",
+                 "sourceusername", "sourcedisplayname", "recorditem", "appname", "refermsg")
+
+    TEXT_FIELDS = frozenset(("type", "title", "des", "url", "thumburl", "showtype",
+                             "sourceusername", "sourcedisplayname", "recorditem"))
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.type: Optional[int] = None
+        self.title: Optional[str] = None
+        self.des: Optional[str] = None
+        self.url: Optional[str] = None
+        self.thumburl: Optional[str] = None
+        self.showtype: Optional[int] = None
+        self.sourceusername: Optional[str] = None
+        self.sourcedisplayname: Optional[str] = None
+        self.recorditem: Optional[str] = None
+        self.appname: Optional[str] = None
+        self.refermsg: Optional[ReferMsg] = None
+
+    @classmethod
+    def parse(cls, xml) -> "AppMsg":
+        """
+        :param xml: parse_xml 得到的 <msg> 根节点
+        """
+        app = cls(xml)
+        if xml.tag != "msg":
+            return app
+        for section in xml:
+            if section.tag == "appmsg":
+                for child in section:
+                    tag = child.tag
+                    if tag in cls.TEXT_FIELDS:
+                        if getattr(app, tag) is None:
+                            setattr(app, tag, child.text)
+                    elif tag == "refermsg" and app.refermsg is None:
+                        app.refermsg = ReferMsg()
+                        for field in child:
+                            if field.tag in ReferMsg.__slots__ and getattr(app.refermsg, field.tag) is None:
+                                setattr(app.refermsg, field.tag, field.text)
+            elif section.tag == "appinfo" and app.appname is None:
+                for child in section:
+                    if child.tag == "appname":
+                        app.appname = child.text
+                        break
+        app.type = _to_int(app.type)
+        app.showtype = _to_int(app.showtype)
+        if app.refermsg is not None:
+            app.refermsg.type = _to_int(app.refermsg.type)
+        return app
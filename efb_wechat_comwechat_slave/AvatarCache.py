@@ -0,0 +1,216 @@
+import hashlib
+import io
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Dict, Optional
+
+from .Utils import download_file, stream_copy
+
+logger = logging.getLogger(__name__)
+
+
+class AvatarCache:
+    """
+    按内容寻址的头像缓存
+    磁盘上按 sha256 存放头像文件，SQLite 记录 wxid -> (url, digest)；ttl 内不再查询头像地址，
+    地址未变时不重复下载。热点头像保存在内存中，同一 wxid 的并发请求只下载一次。
+    命中时只在内存中记录使用时间，由 flush 批量写回，供淘汰时按最近使用排序。
+    """
+
+    def __init__(self, directory: str, lookup: Callable[[str], Optional[str]], ttl: float = 86400,
+                 max_disk: int = 256 * 1024 * 1024, max_memory: int = 16 * 1024 * 1024, timeout: float = 30):
+        """
+        :param directory: 缓存目录
+        :param lookup: 查询头像地址的函数 lookup(wxid) -> url，没有头像时返回 None
+        :param ttl: 头像地址的缓存时间（秒）
+        :param max_disk: 磁盘缓存上限（字节）
+        :param max_memory: 内存缓存上限（字节）
+        :param timeout: 等待其他线程下载同一头像的最长时间（秒）
+        """
+        self.directory = str(directory)
+        self.blob_dir = os.path.join(self.directory, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.lookup = lookup
+        self.ttl = ttl
+        self.max_disk = max_disk
+        self.max_memory = max_memory
+        self.timeout = timeout
+
+        self.hot: "OrderedDict[str, bytes]" = OrderedDict()    # {digest : data}
+        self.hot_size = 0
+        self.inflight: Dict[str, threading.Event] = {}
+        self.used: Dict[str, float] = {}        # {wxid : used_at}，尚未写回的使用时间
+        self.prewarm_queue: queue.Queue = queue.Queue()
+        self.prewarming = set()
+        self.prewarm_worker: Optional[threading.Thread] = None
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(os.path.join(self.directory, "avatars.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS avatars ("
+                        "wxid TEXT PRIMARY KEY, url TEXT, digest TEXT, size INTEGER, "
+                        "fetched_at REAL NOT NULL, used_at REAL NOT NULL)")
+        self.db.commit()
+
+    def get(self, wxid: str) -> Optional[BinaryIO]:
+        """
+        :return: 头像文件，没有头像时返回 None
+        """
+        digest = self._fresh_digest(wxid)
+        if digest is not False:
+            return self._open(digest) if digest else None
+
+        with self.lock:
+            event = self.inflight.get(wxid)
+            leader = event is None
+            if leader:
+                event = self.inflight[wxid] = threading.Event()
+        if not leader:
+            event.wait(self.timeout)
+            digest = self._fresh_digest(wxid)
+            return self._open(digest) if digest else None
+
+        try:
+            digest = self._refresh(wxid)
+        finally:
+            with self.lock:
+                self.inflight.pop(wxid, None)
+            event.set()
+        return self._open(digest) if digest else None
+
+    def prewarm(self, wxid: str):
+        """
+        在后台预先下载头像
+        """
+        with self.lock:
+            if wxid in self.prewarming or self._fresh_digest(wxid) is not False:
+                return
+            self.prewarming.add(wxid)
+            if self.prewarm_worker is None:
+                self.prewarm_worker = threading.Thread(target=self._prewarm_loop, name="avatar-prewarm")
+                self.prewarm_worker.daemon = True
+                self.prewarm_worker.start()
+        self.prewarm_queue.put(wxid)
+
+    def _fresh_digest(self, wxid: str):
+        """
+        :return: 缓存有效时返回 digest（没有头像时为 None），需要刷新时返回 False
+        """
+        with self.lock:
+            row = self.db.execute("SELECT digest, fetched_at FROM avatars WHERE wxid = ?", (wxid,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                return False
+            digest = row[0]
+            if digest and not os.path.exists(self._blob_path(digest)):
+                return False
+            self.used[wxid] = time.time()
+            return digest
+
+    def flush(self) -> bool:
+        """
+        将内存中记录的使用时间批量写回，供 Scheduler 定期调用
+        :return: 是否写回了记录
+        """
+        with self.lock:
+            if not self.used:
+                return False
+            used, self.used = self.used, {}
+            self.db.executemany("UPDATE avatars SET used_at = MAX(used_at, ?) WHERE wxid = ?",
+                                [(used_at, wxid) for wxid, used_at in used.items()])
+            self.db.commit()
+        return True
+
+    def _refresh(self, wxid: str) -> Optional[str]:
+        url = self.lookup(wxid)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT url, digest FROM avatars WHERE wxid = ?", (wxid,)).fetchone()
+            if not url or (row and row[0] == url and row[1] and os.path.exists(self._blob_path(row[1]))):
+                digest = row[1] if url and row else None
+                self._save(wxid, url, digest, now)
+                return digest
+
+        file = download_file(url)
+        try:
+            sha = hashlib.sha256()
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                sha.update(chunk)
+            digest = sha.hexdigest()
+            path = self._blob_path(digest)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    stream_copy(file, f)
+                os.replace(tmp_path, path)
+        finally:
+            file.close()
+
+        with self.lock:
+            self._save(wxid, url, digest, now)
+            self._evict()
+        return digest
+
+    def _save(self, wxid: str, url: Optional[str], digest: Optional[str], now: float):
+        size = os.path.getsize(self._blob_path(digest)) if digest else 0
+        self.db.execute("INSERT OR REPLACE INTO avatars (wxid, url, digest, size, fetched_at, used_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (wxid, url, digest, size, now, now))
+        self.db.commit()
+
+    def _evict(self):
+        self.flush()
+        blobs = self.db.execute("SELECT digest, MAX(size), MAX(used_at) FROM avatars "
+                                "WHERE digest IS NOT NULL GROUP BY digest ORDER BY MAX(used_at)").fetchall()
+        total = sum(size for _, size, _ in blobs)
+        for digest, size, _ in blobs:
+            if total <= self.max_disk:
+                break
+            self.db.execute("DELETE FROM avatars WHERE digest = ?", (digest,))
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+            self._drop_hot(digest)
+            total -= size
+        self.db.commit()
+
+    def _open(self, digest: str) -> BinaryIO:
+        path = self._blob_path(digest)
+        with self.lock:
+            data = self.hot.get(digest)
+            if data is not None:
+                self.hot.move_to_end(digest)
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            with self.lock:
+                if digest not in self.hot and len(data) <= self.max_memory:
+                    self.hot[digest] = data
+                    self.hot_size += len(data)
+                    while self.hot_size > self.max_memory:
+                        self._drop_hot(next(iter(self.hot)))
+        file = io.BytesIO(data)
+        file.name = path
+        return file
+
+    def _drop_hot(self, digest: str):
+        data = self.hot.pop(digest, None)
+        if data is not None:
+            self.hot_size -= len(data)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest)
+
+    def _prewarm_loop(self):
+        while True:
+            wxid = self.prewarm_queue.get()
+            try:
+                self.get(wxid)
+            except Exception as e:
+                logger.debug(f"Failed to prewarm avatar of {wxid}. {e}")
+            finally:
+                with self.lock:
+                    self.prewarming.discard(wxid)
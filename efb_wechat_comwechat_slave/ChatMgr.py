@@ -1,10 +1,12 @@
 # coding: utf-8
 import contextlib
 import logging
-from typing import Dict, Optional, List
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, List, Tuple, Type
 
 from ehforwarderbot.channel import SlaveChannel
-from ehforwarderbot.chat import GroupChat, PrivateChat, ChatMember, SystemChat
+from ehforwarderbot.chat import Chat, GroupChat, PrivateChat, ChatMember, SystemChat
 
 from .CustomTypes import EFBGroupChat, EFBGroupMember, EFBPrivateChat, EFBSystemUser
 
@@ -14,38 +16,37 @@ logger = logging.getLogger(__name__)
 class ChatMgr:
     slave_channel = None
 
+    cache_size: int = 8192     # 联系人刷新时会扩大到不小于联系人数，见 ComWeChatChannel.GetContactListBySql
+    # {(chat class, uid) : (chat, {member uid : member})}, 最近使用的在末尾
+    registry: "OrderedDict[Tuple[Type[Chat], str], Tuple[Chat, Dict[str, ChatMember]]]" = OrderedDict()
+    lock = threading.RLock()
+
     @staticmethod
     def build_efb_chat_as_group(group: EFBGroupChat,
                                 members: Optional[List[EFBGroupMember]] = None) -> GroupChat:
         """
         Build EFB GroupChat object from EFBGroupChat Dict
+        Chats are reused from the registry as long as the given attributes are unchanged.
         :return: GroupChat from group_id
         :param group: EFBGroupChat object, see CustomTypes.py
         :param members: Optional, the member list for the specific group, None by default
                         Each object in members (if not None) must follow the syntax of GroupChat.add_members
         """
-        efb_chat: GroupChat = GroupChat(
-            channel=ChatMgr.slave_channel,
-            **group
-        )
+        efb_chat: GroupChat = ChatMgr.get_or_build(GroupChat, group)
         if members:
             for member in members:
-                efb_chat.add_member(
-                    **member
-                )
+                ChatMgr.build_efb_chat_as_member(efb_chat, member)
         return efb_chat
 
     @staticmethod
     def build_efb_chat_as_private(private: EFBPrivateChat) -> PrivateChat:
         """
         Build EFB PrivateChat object from EFBPrivateChat
+        Chats are reused from the registry as long as the given attributes are unchanged.
         :return: GroupChat from group_id
         :param private: EFBPrivateChat object, see CustomTypes.py
         """
-        efb_chat: PrivateChat = PrivateChat(
-            channel=ChatMgr.slave_channel,
-            **private
-        )
+        efb_chat: PrivateChat = ChatMgr.get_or_build(PrivateChat, private)
         return efb_chat
 
     @staticmethod
@@ -53,18 +54,73 @@ class ChatMgr:
         """
         Build EFB ChatMember object from GroupChat and EFBGroupMember.
         It'll try to get member from GroupChat, if one is not found then a new member is added.
+        A member whose name or alias has changed is replaced.
         :param chat: Original GroupChat
         :param member: EFBGroupMember object, see CustomTypes.py
         :return: Newly built ChatMember
         """
-        with contextlib.suppress(KeyError):
-            return chat.get_member(str(member.get('uid', '')))
-        efb_chat: ChatMember = chat.add_member(
-            **member
-        )
-        return efb_chat
+        uid = str(member.get('uid', ''))
+        with ChatMgr.lock:
+            entry = ChatMgr.registry.get((type(chat), chat.uid))
+            members = entry[1] if entry is not None and entry[0] is chat else None
+            if members is not None:
+                efb_member = members.get(uid)
+            else:
+                efb_member = None
+                with contextlib.suppress(KeyError):
+                    efb_member = chat.get_member(uid)
+
+            if efb_member is not None:
+                if ChatMgr.matches(efb_member, member):
+                    return efb_member
+                with contextlib.suppress(ValueError):
+                    chat.members.remove(efb_member)
+
+            efb_member = chat.add_member(
+                **member
+            )
+            if members is not None:
+                members[uid] = efb_member
+            return efb_member
 
     @staticmethod
     def build_efb_chat_as_system_user(chat: EFBSystemUser):
-        return SystemChat(channel=ChatMgr.slave_channel,
-                          **chat)
\ No newline at end of file
+        return ChatMgr.get_or_build(SystemChat, chat)
+
+    @staticmethod
+    def get_or_build(chat_class: Type[Chat], attributes: Dict) -> Chat:
+        """
+        Look up a chat in the registry, build and register a new one if it is
+        missing or any of the given attributes has changed.
+        :param chat_class: GroupChat, PrivateChat or SystemChat
+        :param attributes: Keyword arguments for chat_class
+        """
+        key = (chat_class, str(attributes.get('uid', '')))
+        with ChatMgr.lock:
+            entry = ChatMgr.registry.get(key)
+            if entry is not None and ChatMgr.matches(entry[0], attributes):
+                ChatMgr.registry.move_to_end(key)
+                return entry[0]
+
+            efb_chat = chat_class(
+                channel=ChatMgr.slave_channel,
+                **attributes
+            )
+            ChatMgr.registry[key] = (efb_chat, {})
+            ChatMgr.registry.move_to_end(key)
+            while len(ChatMgr.registry) > ChatMgr.cache_size:
+                ChatMgr.registry.popitem(last=False)
+            return efb_chat
+
+    @staticmethod
+    def invalidate(uid: str):
+        """
+        Drop every cached chat with the given uid, so the next build creates a fresh one.
+        """
+        with ChatMgr.lock:
+            for key in [key for key in ChatMgr.registry if key[1] == uid]:
+                del ChatMgr.registry[key]
+
+    @staticmethod
+    def matches(chat: Chat, attributes: Dict) -> bool:
+        return all(getattr(chat, k, None) == v for k, v in attributes.items())
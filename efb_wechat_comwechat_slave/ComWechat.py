@@ -1,8 +1,8 @@
 import logging, tempfile
+import functools
 import time
 import threading
 from traceback import print_exc
-from pydub import AudioSegment
 import qrcode
 from pyzbar.pyzbar import decode as pyzbar_decode
 import os
@@ -12,14 +12,15 @@ from xml.sax.saxutils import escape
 
 import re
 import json
+from wechatrobot import ChatRoomData_pb2
 from ehforwarderbot.chat import SystemChat, PrivateChat , SystemChatMember, ChatMember, SelfChatMember
 import hashlib
 from typing import Tuple, Optional, Collection, BinaryIO, Dict, Any , Union , List
 from datetime import datetime
-from cachetools import TTLCache
 
 from ehforwarderbot import MsgType, Chat, Message, Status, coordinator
 from wechatrobot import WeChatRobot
+from wechatrobot.Api import Api
 
 from . import __version__ as version
 
@@ -28,14 +29,28 @@ from ehforwarderbot.types import MessageID, ChatID, InstanceID
 from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.exceptions import EFBException, EFBChatNotFound, EFBMessageError
 from ehforwarderbot.message import MessageCommand, MessageCommands
-from ehforwarderbot.status import MessageRemoval
+from ehforwarderbot.status import MessageRemoval, ChatUpdates
 
+from .AvatarCache import AvatarCache
 from .ChatMgr import ChatMgr
+from .Dedupe import MessageDeduplicator
+from .Dispatcher import ChatDispatcher
+from .GroupRoster import GroupRoster
+from .MediaPool import media_pool
+from .MediaStaging import MediaStager
+from .MessageIndex import MessageIndex
+from .Metrics import metrics
+from .NameResolver import NameResolver
+from .Outbound import OutboundQueue
+from .PendingMedia import PendingMediaTracker
+from .SafeXml import xml_parser
+from .Scheduler import Scheduler
+from .Tracing import tracer
 from .CustomTypes import EFBGroupChat, EFBPrivateChat, EFBGroupMember, EFBSystemUser
-from .MsgDeco import qutoed_text
+from .MsgDeco import qutoed_text, configure_chat_history
 from .MsgProcess import MsgProcess, MsgWrapper
-from .Utils import download_file , load_config , load_temp_file_to_local , WC_EMOTICON_CONVERSION
-from .Constant import QUOTE_MESSAGE
+from .Utils import downloader , voice_transcoder , export_ogg_as_mp3 , pin_temp_file , load_config , convert_wc_emoticons
+from .Constant import QUOTE_MESSAGE, MEMBER_CHANGE_KEYWORDS
 
 from rich.console import Console
 from rich import print as rprint
@@ -43,6 +58,22 @@ from io import BytesIO
 from PIL import Image
 from pyqrcode import QRCode
 
+class MeteredApi(Api):
+    """
+    记录每个机器人接口的调用耗时和异常数
+    """
+
+    def post(self, type : int, params) -> Dict:
+        api = params.__class__.__name__.replace("Body", "")
+        begin = time.monotonic()
+        try:
+            return super().post(type, params)
+        except Exception:
+            metrics.inc("comwechat_robot_api_errors_total", api = api)
+            raise
+        finally:
+            metrics.observe("comwechat_robot_api_seconds", time.monotonic() - begin, api = api)
+
 class ComWeChatChannel(SlaveChannel):
     channel_name : str = "ComWechatChannel"
     channel_emoji : str = "💻"
@@ -51,17 +82,18 @@ class ComWeChatChannel(SlaveChannel):
     bot : WeChatRobot = None
     config : Dict = {}
 
-    friends : EFBPrivateChat = []
-    groups : EFBGroupChat    = []
+    # 以下联系人表在 __init__ 中按实例创建；刷新时构建新表后整体替换，读取方无需加锁
+    friends : Dict[ChatID, PrivateChat]         # {wxid : PrivateChat}
+    groups : Dict[ChatID, 'Chat']               # {chatroom id : GroupChat}
+    chats : Tuple['Chat', ...]                  # get_chats 返回的快照，联系人变化时重建
 
-    contacts : Dict = {}            # {wxid : {alias : str , remark : str, nickname : str , type : int}} -> {wxid : name(after handle)}
-    group_members : Dict = {}       # {"group_id" : { "wxID" : "displayName"}}
+    contacts : Dict                 # {wxid : {alias : str , remark : str, nickname : str , type : int}} -> {wxid : name(after handle)}
+    contact_snapshot : Dict         # 上次同步的联系人 {wxid : (remark, nickname, type)}
+    group_members : GroupRoster = None  # {"group_id" : { "wxID" : "displayName"}}，按群懒加载
 
     time_out : int = 120
-    cache =  TTLCache(maxsize=200, ttl= time_out)  # 缓存发送过的消息ID
-    file_msg : Dict = {}                           # 存储待修改的文件类消息 {path : msg}
-    delete_file : Dict = {}                        # 存储待删除的消息 {path : time}
     forward_pattern = r"ehforwarderbot:\/\/([^/]+)\/forward\/(\d+)"
+    emoticon_msg_types = {"text", "sysmsg"}         # 携带用户文本、需要转换表情的消息类型，引用消息在 MsgDeco 中单独转换
 
     __version__ = version.__version__
     logger: logging.Logger = logging.getLogger("comwechat")
@@ -69,13 +101,21 @@ class ComWeChatChannel(SlaveChannel):
 
     #MsgType.Voice
     supported_message_types = {MsgType.Text, MsgType.Sticker, MsgType.Image , MsgType.Link , MsgType.File , MsgType.Video , MsgType.Animation, MsgType.Voice}
+    file_msg_types = {MsgType.Sticker, MsgType.Image , MsgType.File , MsgType.Video , MsgType.Animation, MsgType.Voice}
 
     def __init__(self, instance_id: InstanceID = None):
         super().__init__(instance_id=instance_id)
         self.logger.info("ComWeChat Slave Channel initialized.")
         self.logger.info("Version: %s" % self.__version__)
         self.config = load_config(efb_utils.get_config_path(self.channel_id))
+        self.friends = {}
+        self.groups = {}
+        self.chats = ()
+        self.contacts = {}
+        self.contact_snapshot = {}
+        self.contacts_lock = threading.Lock()       # 串行化联系人刷新（定时任务与 master 的 get_chat 可能同时触发）
         self.bot = WeChatRobot()
+        self.bot.api = MeteredApi()
 
         self.qr_url = ""
         self.master_qr_picture_id: Optional[str] = None
@@ -84,6 +124,10 @@ class ComWeChatChannel(SlaveChannel):
                                     uid=ChatID("__ews_user_auth__"))
 
         self.qrcode_timeout = self.config.get("qrcode_timeout", 10)
+        media_pool.configure(
+            workers = self.config.get("media_workers", 2),
+            timeout = self.config.get("media_timeout", 60),
+        )
         self.login()
         self.me = self.bot.GetSelfInfo()["data"]
         self.wxid = self.me["wxId"]
@@ -91,9 +135,98 @@ class ComWeChatChannel(SlaveChannel):
         self.dir = self.config["dir"]
         if not self.dir.endswith(os.path.sep):
             self.dir += os.path.sep
+        downloader.configure(
+            max_concurrency = self.config.get("download_concurrency", 8),
+            pool_size = self.config.get("download_pool_size", 16),
+        )
+        voice_transcoder.configure(warm_workers = self.config.get("voice_encoder_workers", 1))
+        xml_parser.configure(
+            max_bytes = int(self.config.get("xml_max_kb", 1024) * 1024),
+            max_depth = self.config.get("xml_max_depth", 64),
+            max_nodes = self.config.get("xml_max_nodes", 100000),
+        )
+        configure_chat_history(
+            max_items = self.config.get("chat_history_max_items", 500),
+            max_depth = self.config.get("chat_history_max_depth", 4),
+            max_chars = self.config.get("chat_history_max_chars", 4000),
+        )
+        self.stager = MediaStager(f"{self.dir}{self.wxid}/", quota = int(self.config.get("staging_quota_mb", 2048) * 1024 * 1024))
         ChatMgr.slave_channel = self
+        self.chat_cache_size = self.config.get("chat_cache_size", 8192)
+        ChatMgr.cache_size = self.chat_cache_size
+        self.dispatcher = ChatDispatcher(
+            workers = self.config.get("dispatch_workers", 4),
+            queue_size = self.config.get("dispatch_queue_size", 1000),
+        )
+        self.dedupe = MessageDeduplicator(
+            ttl = self.config.get("dedupe_ttl", 3600),
+            memory_budget = int(self.config.get("dedupe_memory_mb", 4) * 1024 * 1024),
+            db_path = str(efb_utils.get_data_path(self.channel_id) / "dedupe.sqlite") if self.config.get("dedupe_persist", False) else None,
+        )
+        self.name_resolver = NameResolver(
+            self.GetContactNamesBySql,
+            positive_ttl = self.config.get("name_cache_ttl", 3600),
+            negative_ttl = self.config.get("name_negative_ttl", 300),
+        )
+        self.group_members = GroupRoster(
+            self.GetGroupMembersBySql,
+            max_members = self.config.get("group_member_cache_size", 50000),
+            ttl = self.config.get("group_member_ttl", 1800),
+        )
+        self.scheduler = Scheduler()
+        self.scheduler.add_job(
+            "contacts", self.GetContactListBySql,
+            interval = self.config.get("contact_refresh_interval", 1800),
+            max_interval = self.config.get("contact_refresh_max_interval", 7200),
+        )
+        self.pending_media = PendingMediaTracker(self.time_out, on_ready = self.on_file_ready, probe = self.probe_voice_msg)
+        self.avatars = AvatarCache(
+            efb_utils.get_data_path(self.channel_id) / "avatars",
+            lambda wxid: self.bot.GetPictureBySql(wxid = wxid),
+            ttl = self.config.get("avatar_ttl", 86400),
+            max_disk = int(self.config.get("avatar_cache_mb", 256) * 1024 * 1024),
+            max_memory = int(self.config.get("avatar_memory_mb", 16) * 1024 * 1024),
+        )
+        self.scheduler.add_job("avatar_cache", self.avatars.flush, interval = 600)
+        self.avatar_prewarm = self.config.get("avatar_prewarm", False)
+        self.messages = MessageIndex(
+            str(efb_utils.get_data_path(self.channel_id) / "messages.sqlite"),
+            ttl = self.config.get("message_index_ttl", 7 * 86400),
+            hot_size = self.config.get("message_index_hot_size", 2048),
+            max_xml = int(self.config.get("message_index_max_xml_kb", 64) * 1024),
+            pinned_ttl = self.config.get("message_index_slim_ttl", 90 * 86400),
+        )
+        self.scheduler.add_job("message_index", self.messages.compact, interval = 3600)
+        self.slim_vendor_specific = self.config.get("slim_vendor_specific", False)
+        tracer.configure(
+            str(efb_utils.get_data_path(self.channel_id) / "traces.jsonl"),
+            sample_rate = self.config.get("trace_sample_rate", 0.0),
+            max_bytes = int(self.config.get("trace_file_mb", 10) * 1024 * 1024),
+            backup_count = self.config.get("trace_file_backups", 3),
+        )
+        self.scheduler.add_job("traces", lambda: tracer.expire(self.time_out * 2), interval = 600)
+        self.outbound = OutboundQueue(
+            self.report_send_failure,
+            workers = self.config.get("send_workers", 2),
+            queue_size = self.config.get("send_queue_size", 1000),
+            rate = self.config.get("send_rate", 1.0),
+            burst = self.config.get("send_burst", 5),
+            retries = self.config.get("send_retries", 3),
+        )
+        self.last_callback = time.monotonic()
+        metrics.gauge("comwechat_seconds_since_last_callback", lambda: time.monotonic() - self.last_callback)
+        metrics.gauge("comwechat_pending_files", lambda: len(self.pending_media.file_msg))
+        metrics.gauge("comwechat_pending_deletes", lambda: len(self.pending_media.delete_file))
+        metrics.gauge("comwechat_dedupe_hit_ratio", self.dedupe.hit_rate)
+        metrics.gauge("comwechat_dispatch_pending", self.dispatcher.pending)
+        metrics.gauge("comwechat_outbound_pending", self.outbound.pending)
+
+        @self.bot.on("self_msg", "friend_msg", "group_msg", "revoke_msg", "transfer_msg", "frdver_msg")
+        def on_any_msg(msg : Dict):
+            self.last_callback = time.monotonic()
 
         @self.bot.on("self_msg")
+        @self.dispatcher.by_chat
         def on_self_msg(msg : Dict):
             self.logger.debug(f"self_msg:{msg}")
             sender = msg["sender"]
@@ -118,6 +251,7 @@ class ComWeChatChannel(SlaveChannel):
             self.handle_msg(msg , author , chat)
 
         @self.bot.on("friend_msg")
+        @self.dispatcher.by_chat
         def on_friend_msg(msg : Dict):
             self.logger.debug(f"friend_msg:{msg}")
 
@@ -139,11 +273,16 @@ class ComWeChatChannel(SlaveChannel):
             self.handle_msg(msg, author, chat)
 
         @self.bot.on("group_msg")
+        @self.dispatcher.by_chat
         def on_group_msg(msg : Dict):
             self.logger.debug(f"group_msg:{msg}")
             sender = msg["sender"]
             wxid  =  msg["wxid"]
 
+            if msg["type"] == "eventnotify" or (msg["type"] in ("sysmsg", "other") and any(k in msg["message"] for k in MEMBER_CHANGE_KEYWORDS)):
+                self.group_members.refresh(sender)
+                self.scheduler.hasten("contacts", 60)
+
             chatname = self.get_name_by_wxid(sender)
 
             chat = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
@@ -159,11 +298,12 @@ class ComWeChatChannel(SlaveChannel):
             author = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
                 uid = wxid,
                 name = name,
-                alias = self.group_members.get(sender,{}).get(wxid , None),
+                alias = self.group_members.get(sender).get(wxid , None),
             ))
             self.handle_msg(msg, author, chat)
 
         @self.bot.on("revoke_msg")
+        @self.dispatcher.by_chat
         def on_revoked_msg(msg : Dict):
             self.logger.debug(f"revoke_msg:{msg}")
             sender = msg["sender"]
@@ -184,6 +324,10 @@ class ComWeChatChannel(SlaveChannel):
                 ))
 
             newmsgid = re.search("<newmsgid>(.*?)<\/newmsgid>", msg["message"]).group(1)
+            if newmsgid not in self.messages:
+                self.logger.debug(f"撤回的消息 {newmsgid} 未投递过，忽略")
+                return
+            self.messages.forget(newmsgid)
 
             efb_msg = Message(chat = chat , uid = newmsgid)
             coordinator.send_status(
@@ -191,6 +335,7 @@ class ComWeChatChannel(SlaveChannel):
             )
 
         @self.bot.on("transfer_msg")
+        @self.dispatcher.by_chat
         def on_transfer_msg(msg : Dict):
             self.logger.debug(f"transfer_msg:{msg}")
             sender = msg["sender"]
@@ -345,7 +490,7 @@ class ComWeChatChannel(SlaveChannel):
         if not file:
             return False
             
-        url = self.decode_qr_code(file)
+        url = media_pool.run("qr", self.decode_qr_code, file.name)
         if not url:
             os.unlink(file.name)  # 删除临时文件
             return False
@@ -374,9 +519,9 @@ class ComWeChatChannel(SlaveChannel):
         return tmp_file
 
     @staticmethod
-    def decode_qr_code(file):
-        # 从临时文件读取图片并解码二维码数据
-        qr_img = Image.open(file.name)
+    def decode_qr_code(path):
+        # 从临时文件读取图片并解码二维码数据，在媒体进程池中运行
+        qr_img = Image.open(path)
         try:
             return pyzbar_decode(qr_img)[0].data.decode('utf-8')
         except IndexError:
@@ -432,7 +577,8 @@ class ComWeChatChannel(SlaveChannel):
         for efb_msg in efb_msgs:
             for k, v in kwargs.items():
                 setattr(efb_msg, k, v)
-            coordinator.send_message(efb_msg)
+            with metrics.timed("comwechat_master_delivery_seconds"), tracer.span("send_efb_msgs"):
+                coordinator.send_message(efb_msg)
             if efb_msg.file:
                 efb_msg.file.close()
 
@@ -465,86 +611,87 @@ class ComWeChatChannel(SlaveChannel):
         self.send_efb_msgs(msg, uid=int(time.time()), chat=chat, author=author, type=MsgType.Text)
 
     def handle_msg(self , msg : Dict[str, Any] , author : 'ChatMember' , chat : 'Chat'):
-        emojiList = re.findall('\[[\w|！|!| ]+\]' , msg["message"])
-        for emoji in emojiList:
-            try:
-                msg["message"] = msg["message"].replace(emoji, WC_EMOTICON_CONVERSION[emoji])
-            except:
-                pass
+        metrics.inc("comwechat_messages_total", type = msg["type"])
+        if msg["type"] in self.emoticon_msg_types:
+            msg["message"] = convert_wc_emoticons(msg["message"])
 
-        if msg["msgid"] not in self.cache:
-            self.cache[msg["msgid"]] = msg["type"]
-        else:
-            if self.cache[msg["msgid"]] == msg["type"]:
-                return
+        if self.dedupe.seen(msg["msgid"], msg["type"]):
+            return
 
-        try:
-            if ("FileStorage" in msg["filepath"]) and ("Cache" not in msg["filepath"]):
-                msg["timestamp"] = int(time.time())
-                msg["filepath"] = msg["filepath"].replace("\\","/")
-                msg["filepath"] = f'''{self.dir}{msg["filepath"]}'''
-                self.file_msg[msg["filepath"]] = ( msg , author , chat )
-                return
-            if msg["type"] == "video":
-                msg["timestamp"] = int(time.time())
-                msg["filepath"] = msg["thumb_path"].replace("\\","/").replace(".jpg", ".mp4")
-                msg["filepath"] = f'''{self.dir}{msg["filepath"]}'''
-                self.file_msg[msg["filepath"]] = ( msg , author , chat )
-                return
-        except:
-            ...
+        pending = None
+        with tracer.trace(msg["msgid"], "handle_msg", type = msg["type"]):
+            if self.avatar_prewarm:
+                self.avatars.prewarm(chat.uid)
 
-        if msg["type"] == "voice":
-            file_path = re.search("clientmsgid=\"(.*?)\"", msg["message"]).group(1) + ".amr"
-            msg["timestamp"] = int(time.time())
-            msg["filepath"] = f'''{self.dir}{msg["self"]}/{file_path}'''
-            self.file_msg[msg["filepath"]] = ( msg , author , chat )
-            return
+            try:
+                if ("FileStorage" in msg["filepath"]) and ("Cache" not in msg["filepath"]):
+                    msg["filepath"] = msg["filepath"].replace("\\","/")
+                    msg["filepath"] = f'''{self.dir}{msg["filepath"]}'''
+                    pending = msg["filepath"]
+                elif msg["type"] == "video":
+                    msg["filepath"] = msg["thumb_path"].replace("\\","/").replace(".jpg", ".mp4")
+                    msg["filepath"] = f'''{self.dir}{msg["filepath"]}'''
+                    pending = msg["filepath"]
+            except:
+                ...
 
-        self.send_efb_msgs(MsgWrapper(msg, MsgProcess(msg, chat)), author=author, chat=chat, uid=MessageID(str(msg['msgid'])))
+            if pending is None and msg["type"] == "voice":
+                file_path = re.search("clientmsgid=\"(.*?)\"", msg["message"]).group(1) + ".amr"
+                msg["filepath"] = f'''{self.dir}{msg["self"]}/{file_path}'''
+                pending = msg["filepath"]
 
-    def handle_file_msg(self):
-        while True:
-            if len(self.file_msg) == 0:
-                time.sleep(1)
+            if pending is None:
+                self.send_to_master(msg, author, chat)
             else:
-                for path in list(self.file_msg.keys()):
-                    flag = False
-                    msg = self.file_msg[path][0]
-                    author = self.file_msg[path][1]
-                    chat = self.file_msg[path][2]
-                    if os.path.exists(path):
-                        flag = True
-                    elif (int(time.time()) - msg["timestamp"]) > self.time_out:
-                        msg_type = msg["type"]
-                        msg['message'] = f"[{msg_type} 下载超时,请在手机端查看]"
-                        msg["type"] = "text"
-                        flag = True
-                    elif msg["type"] == "voice":
-                        sql = f'SELECT Buf FROM Media WHERE Reserved0 = {msg["msgid"]}'
-                        dbresult = self.bot.QueryDatabase(db_handle=self.bot.GetDBHandle("MediaMSG0.db"), sql=sql)["data"]
-                        if len(dbresult) == 2:
-                            filebuffer = dbresult[1][0]
-                            decoded = bytes(base64.b64decode(filebuffer))
-                            with open(msg["filepath"], 'wb') as f:
-                                f.write(decoded)
-                            f.close()
-                            flag = True
-
-                    if flag:
-                        del self.file_msg[path]
-                        self.send_efb_msgs(MsgWrapper(msg, MsgProcess(msg, chat)), author=author, chat=chat, uid=MessageID(str(msg['msgid'])))
-
-            if len(self.delete_file):
-                for k in list(self.delete_file.keys()):
-                    file_path = k
-                    begin_time = self.delete_file[k]
-                    if  (int(time.time()) - begin_time) > self.time_out:
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-                        del self.delete_file[file_path]
+                tracer.suspend()
+        # 追踪在 with 退出时才转入等待，此后再交给下载线程
+        if pending is not None:
+            self.pending_media.add(pending, ( msg , author , chat ))
+
+    def on_file_ready(self, item : Tuple[Dict[str, Any], 'ChatMember', 'Chat'], timed_out : bool):
+        """
+        PendingMediaTracker 只负责发现文件就绪，转换和投递交给聊天对应的分片，保证聊天内顺序且不阻塞跟踪线程
+        """
+        self.dispatcher.submit(item[2].uid, self.handle_file_msg, item, timed_out)
+
+    def handle_file_msg(self, item : Tuple[Dict[str, Any], 'ChatMember', 'Chat'], timed_out : bool):
+        msg, author, chat = item
+        if timed_out:
+            msg_type = msg["type"]
+            msg['message'] = f"[{msg_type} 下载超时,请在手机端查看]"
+            msg["type"] = "text"
+        with tracer.resume(msg["msgid"], "handle_file_msg", timed_out = timed_out):
+            self.send_to_master(msg, author, chat)
+
+    def send_to_master(self, msg : Dict[str, Any], author : 'ChatMember', chat : 'Chat'):
+        """
+        转换并投递消息，同时记入消息索引；slim_vendor_specific 时 master 只能通过索引取回原始内容
+        """
+        xml = msg.get("message")
+        with metrics.timed("comwechat_parse_seconds", type = msg["type"]), tracer.span("MsgProcess"):
+            efb_msgs = MsgWrapper(msg, MsgProcess(msg, chat), slim = self.slim_vendor_specific)
+        if efb_msgs:
+            info = {k: v for k, v in msg.items() if k != "message"}
+            self.messages.record(msg["msgid"], chat.uid, author.uid, author.name, msg["type"],
+                                 efb_msgs[0].type.name, efb_msgs[0].text, xml, info, pinned = self.slim_vendor_specific)
+        self.send_efb_msgs(efb_msgs, author=author, chat=chat, uid=MessageID(str(msg['msgid'])))
+
+    def probe_voice_msg(self, path : str, item : Tuple[Dict[str, Any], 'ChatMember', 'Chat']) -> bool:
+        """
+        语音文件不会落盘，从 MediaMSG0.db 中读取并写入 path
+        """
+        msg = item[0]
+        if msg["type"] != "voice":
+            return False
+        sql = f'SELECT Buf FROM Media WHERE Reserved0 = {msg["msgid"]}'
+        dbresult = self.bot.QueryDatabase(db_handle=self.bot.GetDBHandle("MediaMSG0.db"), sql=sql)["data"]
+        if len(dbresult) != 2:
+            return False
+        filebuffer = dbresult[1][0]
+        decoded = bytes(base64.b64decode(filebuffer))
+        with open(path, 'wb') as f:
+            f.write(decoded)
+        return True
 
     def process_friend_request(self , v3 , v4):
         self.logger.debug(f"process_friend_request:{v3} {v4}")
@@ -568,38 +715,22 @@ class ComWeChatChannel(SlaveChannel):
         else:
             return "Failed"
 
-    # 定时任务
-    def scheduled_job(self):
-        count = 1
-        while True:
-            time.sleep(1)
-            if count % 1800 == 1:
-                self.GetGroupListBySql()
-                self.GetContactListBySql()
-                count = 1
-            else:
-                count += 1
-
     #获取全部联系人
     def get_chats(self) -> Collection['Chat']:
         if not self.friends and not self.groups:
             self.GetContactListBySql()
-        return self.groups + self.friends
+        return self.chats
 
     #获取联系人
     def get_chat(self, chat_uid: ChatID) -> 'Chat':
         if not self.friends and not self.groups:
             self.GetContactListBySql()
 
-        if "@chatroom" in chat_uid:
-            for group in self.groups:
-                if group.uid == chat_uid:
-                    return group
-        else:
-            for friend in self.friends:
-                if friend.uid == chat_uid:
-                    return friend
-        raise EFBChatNotFound
+        chats = self.groups if "@chatroom" in chat_uid else self.friends
+        try:
+            return chats[chat_uid]
+        except KeyError:
+            raise EFBChatNotFound
 
     #发送消息
     def send_message(self, msg : Message) -> Message:
@@ -614,29 +745,55 @@ class ComWeChatChannel(SlaveChannel):
                 if match.group(1) == hashlib.md5(self.channel_id.encode('utf-8')).hexdigest():
                     msgid = match.group(2)
                     self.logger.debug(f"提取到的消息 ID: {msgid}")
-                    self.bot.ForwardMessage(wxid = chat_uid, msgid = msgid)
+                    self.outbound.submit(chat_uid, lambda _: self.outbound.call(self.bot.ForwardMessage, wxid = chat_uid, msgid = msgid), msg)
                 else:
                     self.logger.debug(f"非本 slave 消息: {match.group(1)}/{match.group(2)}")
                 return msg
 
+        # master 在 send_message 返回后即关闭并删除 msg.file，入队前先固定一份自有的副本
+        file = pin_temp_file(msg.file) if msg.file is not None and msg.type in self.file_msg_types else None
+        self.outbound.submit(chat_uid, functools.partial(self.deliver_message, file = file), msg)
+        return msg
+
+    def deliver_message(self, msg : Message, file : Optional[BinaryIO] = None):
+        """
+        在发送队列的工作线程上执行 send_message 的实际发送
+        :param file: send_message 固定的 msg.file 副本，发送结束后关闭
+        """
+        try:
+            self.send_to_wechat(msg, file)
+        finally:
+            if file is not None:
+                file.close()
+
+    def send_to_wechat(self, msg : Message, file : Optional[BinaryIO]):
+        chat_uid = msg.chat.uid
+        res = None
+
         if msg.type == MsgType.Voice:
-            f = tempfile.NamedTemporaryFile(prefix='voice_message_', suffix=".mp3")
-            AudioSegment.from_ogg(msg.file.name).export(f, format="mp3")
-            msg.file = f
-            msg.file.name = "语音留言.mp3"
-            msg.type = MsgType.Video
-            msg.filename = os.path.basename(f.name)
+            name = "语音留言.mp3"
+            with tempfile.NamedTemporaryFile(prefix='voice_message_', suffix=".mp3") as f:
+                with self.stager.timed("transcode"):
+                    media_pool.run("ogg2mp3", export_ogg_as_mp3, file.name, f.name)
+                local_path = self.stager.stage(f, name)
+        elif file is not None:
+            if msg.type in [MsgType.File , MsgType.Video] and msg.filename:
+                name = msg.filename
+            else:
+                name = os.path.basename(msg.file.name)
+            local_path = self.stager.stage(file, name)
 
         if msg.type in [MsgType.Text]:
             if msg.text.startswith('/changename'):
                 newname = msg.text.strip('/changename ')
-                res = self.bot.SetChatroomName(chatroom_id = chat_uid , chatroom_name = newname)
+                res = self.outbound.call(self.bot.SetChatroomName, chatroom_id = chat_uid , chatroom_name = newname)
             elif msg.text.startswith('/getmemberlist'):
                 memberlist = self.bot.GetChatroomMemberList(chatroom_id = chat_uid)
+                roster = self.group_members.get(chat_uid)
                 message = '群组成员包括：'
                 for wxid in memberlist['members'].split('^G'):
                     try:
-                        name = self.contacts[wxid]
+                        name = self.contacts.get(wxid) or roster[wxid]
                     except:
                         try:
                             name = self.bot.GetChatroomMemberNickname(chatroom_id = chat_uid, wxid = wxid)['nickname'] or wxid
@@ -647,15 +804,37 @@ class ComWeChatChannel(SlaveChannel):
             elif msg.text.startswith('/getstaticinfo'):
                 info = msg.text[15::]
                 if info == 'friends':
-                    message = str(self.friends)
+                    message = str(list(self.friends.values()))
                 elif info == 'groups':
-                    message = str(self.groups)
+                    message = str(list(self.groups.values()))
                 elif info == 'group_members':
-                    message = json.dumps(self.group_members)
+                    message = json.dumps(self.group_members.snapshot())
                 elif info == 'contacts':
                     message = json.dumps(self.contacts)
+                elif info == 'media_pool':
+                    message = json.dumps(media_pool.stats())
+                elif info == 'outbound':
+                    message = json.dumps(self.outbound.stats())
+                elif info == 'staging':
+                    message = json.dumps(self.stager.stats())
                 else:
-                    message = '当前仅支持查询friends, groups, group_members, contacts'
+                    message = '当前仅支持查询friends, groups, group_members, contacts, media_pool, outbound, staging'
+                self.system_msg({'sender':chat_uid, 'message':message})
+            elif msg.text.startswith('/trace'):
+                msgid = msg.target.uid if isinstance(msg.target, Message) else msg.text[7::].strip()
+                record = tracer.get(msgid)
+                if record:
+                    message = tracer.format(record)
+                else:
+                    message = f'没有 {msgid} 的追踪记录（未抽样或已轮转）'
+                self.system_msg({'sender':chat_uid, 'message':message})
+            elif msg.text.startswith('/refresh'):
+                name = msg.text[9::].strip() or "contacts"
+                if self.scheduler.run_now(name):
+                    message = f'已触发 {name} 刷新'
+                else:
+                    message = f'未知任务 {name}'
+                message += '\n' + '\n'.join(str(job) for job in self.scheduler.jobs.values())
                 self.system_msg({'sender':chat_uid, 'message':message})
             elif msg.text.startswith('/helpcomwechat'):
                 message = '''/search - 按关键字匹配好友昵称搜索联系人
@@ -672,7 +851,11 @@ class ComWeChatChannel(SlaveChannel):
 
 /addfriend - 后面格式'wxid message'
 
-/getstaticinfo - 可获取friends, groups, contacts信息'''
+/refresh - 立即刷新联系人，并查看定时任务状态
+
+/trace - 后面跟消息ID，或回复一条消息，查看该消息各处理阶段的耗时
+
+/getstaticinfo - 可获取friends, groups, contacts, media_pool, outbound, staging信息'''
                 self.system_msg({'sender':chat_uid, 'message':message})
             elif msg.text.startswith('/search'):
                 keyword = msg.text[8::]
@@ -683,7 +866,7 @@ class ComWeChatChannel(SlaveChannel):
                 self.system_msg({'sender':chat_uid, 'message':message})
             elif msg.text.startswith('/addtogroup'):
                 users = msg.text[12::]
-                res = self.bot.AddChatroomMember(chatroom_id = chat_uid, wxids = users)
+                res = self.outbound.call(self.bot.AddChatroomMember, chatroom_id = chat_uid, wxids = users)
             elif msg.text.startswith('/forward'):
                 if isinstance(msg.target, Message):
                     msgid = msg.target.uid
@@ -714,9 +897,9 @@ class ComWeChatChannel(SlaveChannel):
                 else:
                     users, message = users_message[0], ''
                 if users != '':
-                    res = self.bot.SendAt(chatroom_id = chat_uid, wxids = users, msg = message)
+                    res = self.outbound.call(self.bot.SendAt, chatroom_id = chat_uid, wxids = users, msg = message)
                 else:
-                    self.bot.SendText(wxid = chat_uid , msg = msg.text)
+                    self.outbound.call(self.bot.SendText, wxid = chat_uid , msg = msg.text)
             elif msg.text.startswith('/sendcard'):
                 user_nickname = msg.text[10::].split(' ', 1)
                 if len(user_nickname) == 2:
@@ -724,9 +907,9 @@ class ComWeChatChannel(SlaveChannel):
                 else:
                     user, nickname = user_nickname[0], ''
                 if user != '':
-                    res = self.bot.SendCard(receiver = chat_uid, share_wxid = user, nickname = nickname)
+                    res = self.outbound.call(self.bot.SendCard, receiver = chat_uid, share_wxid = user, nickname = nickname)
                 else:
-                    self.bot.SendText(wxid = chat_uid , msg = msg.text)
+                    self.outbound.call(self.bot.SendText, wxid = chat_uid , msg = msg.text)
             elif msg.text.startswith('/addfriend'):
                 user_invite = msg.text[11::].split(' ', 1)
                 if len(user_invite) == 2:
@@ -734,56 +917,49 @@ class ComWeChatChannel(SlaveChannel):
                 else:
                     user, invite = user_invite[0], ''
                 if user != '':
-                    res = self.bot.AddContactByWxid(wxid = user, msg = invite)
+                    res = self.outbound.call(self.bot.AddContactByWxid, wxid = user, msg = invite)
                 else:
-                    self.bot.SendText(wxid = chat_uid , msg = msg.text)
+                    self.outbound.call(self.bot.SendText, wxid = chat_uid , msg = msg.text)
             else:
                 res = self.send_text(wxid = chat_uid , msg = msg)
         elif msg.type in [MsgType.Link]:
             self.send_text(wxid = chat_uid , msg = msg)
         elif msg.type in [MsgType.Image , MsgType.Sticker]:
-            name = os.path.basename(msg.file.name)
-            local_path =f"{self.dir}{self.wxid}/{name}"
-            load_temp_file_to_local(msg.file, local_path)
-            img_path = self.base_path + "\\" + self.wxid + "\\" + name
-            res = self.bot.SendImage(receiver = chat_uid , img_path = img_path)
-            self.delete_file[local_path] = int(time.time())
+            img_path = self.wechat_path(local_path)
+            with self.stager.timed("send"):
+                res = self.outbound.call(self.bot.SendImage, receiver = chat_uid , img_path = img_path)
+            self.pending_media.delete_later(local_path)
             if msg.text:
                 self.send_text(wxid = chat_uid , msg = msg)
-        elif msg.type in [MsgType.File , MsgType.Video]:
-            name = os.path.basename(msg.file.name)
-            local_path = f"{self.dir}{self.wxid}/{name}"
-            load_temp_file_to_local(msg.file, local_path)
-            file_path = self.base_path + "\\" + self.wxid + "\\" + name
-            if msg.filename:
-                try:
-                    os.rename(local_path , f"{self.dir}{self.wxid}/{msg.filename}")
-                except:
-                    os.replace(local_path , f"{self.dir}{self.wxid}/{msg.filename}")
-                local_path = f"{self.dir}{self.wxid}/{msg.filename}"
-                file_path = self.base_path + "\\" + self.wxid + "\\" + msg.filename
-            res = self.bot.SendFile(receiver = chat_uid , file_path = file_path)
-            self.delete_file[local_path] = int(time.time())
+        elif msg.type in [MsgType.File , MsgType.Video , MsgType.Voice]:
+            file_path = self.wechat_path(local_path)
+            with self.stager.timed("send"):
+                res = self.outbound.call(self.bot.SendFile, receiver = chat_uid , file_path = file_path)
+            self.pending_media.delete_later(local_path)
             if msg.text:
                 self.send_text(wxid = chat_uid , msg = msg)
-            if msg.type == MsgType.Video:
+            if msg.type in [MsgType.Video , MsgType.Voice]:
                 res["msg"] = 1
         elif msg.type in [MsgType.Animation]:
-            name = os.path.basename(msg.file.name)
-            local_path = f"{self.dir}{self.wxid}/{name}"
-            load_temp_file_to_local(msg.file, local_path)
-            file_path = self.base_path + "\\" + self.wxid + "\\" + local_path.split("/")[-1]
-            res = self.bot.SendEmotion(wxid = chat_uid , img_path = file_path)
-            self.delete_file[local_path] = int(time.time())
+            file_path = self.wechat_path(local_path)
+            with self.stager.timed("send"):
+                res = self.outbound.call(self.bot.SendEmotion, wxid = chat_uid , img_path = file_path)
+            self.pending_media.delete_later(local_path)
             if msg.text:
                 self.send_text(wxid = chat_uid , msg = msg)
 
-        try:
-            if str(res["msg"]) == "0":
-                raise EFBMessageError("发送失败，请在手机端确认")
-        except:
-            ...
-        return msg
+        if isinstance(res, dict) and str(res.get("msg")) == "0":
+            raise EFBMessageError("发送失败，请在手机端确认")
+
+    def wechat_path(self, local_path : str) -> str:
+        """
+        暂存文件在 WeChat 一侧的路径
+        """
+        return "\\".join([self.base_path, self.wxid] + self.stager.relpath(local_path).split(os.path.sep))
+
+    def report_send_failure(self, chat_uid : ChatID, msg : Message, e : Exception):
+        summary = (msg.text or msg.filename or msg.type.name)[:50]
+        self.system_msg({'sender': chat_uid, 'message': f"消息发送失败: {e}\n{summary}"})
 
     def send_text(self, wxid: ChatID, msg: Message) -> 'Message':
         text = msg.text
@@ -795,12 +971,14 @@ class ComWeChatChannel(SlaveChannel):
                     msgid = msg.target.uid
                     sender = msg.target.author.uid
                     displayname = msg.target.author.name
-                    content = escape(msg.target.vendor_specific.get("wx_xml", ""), {
+                    indexed = self.messages.get(msg.target.vendor_specific.get("wx_ref", msgid))
+                    content = escape(msg.target.vendor_specific.get("wx_xml") or (indexed and indexed.xml) or "", {
                         "\n": "&#x0A;",
                         "\t": "&#x09;",
                         '"': "&quot;",
-                    }) or msg.target.text
-                    comwechat_info = msg.target.vendor_specific.get("comwechat_info", {})
+                    }) or msg.target.text or (indexed and indexed.text)
+                    comwechat_info = msg.target.vendor_specific.get("comwechat_info") \
+                        or {"type": msg.target.vendor_specific.get("wx_type") or (indexed and indexed.wx_type)}
                     if comwechat_info.get("type", None) == "animatedsticker":
                         refer_type = 47
                     elif msg.target.type == MsgType.Image:
@@ -824,33 +1002,28 @@ class ComWeChatChannel(SlaveChannel):
                     else:
                         content = "<content />"
                     xml = QUOTE_MESSAGE % (self.wxid, text, refer_type, msgid, sender, sender, displayname, content)
-                    return self.bot.SendXml(wxid = wxid , xml = xml, img_path = "")
-        return self.bot.SendText(wxid = wxid , msg = text)
+                    return self.outbound.call(self.bot.SendXml, wxid = wxid , xml = xml, img_path = "")
+        return self.outbound.call(self.bot.SendText, wxid = wxid , msg = text)
 
     def get_chat_picture(self, chat: 'Chat') -> BinaryIO:
-        wxid = chat.uid
-        result = self.bot.GetPictureBySql(wxid = wxid)
-        if result:
-            return download_file(result)
-        else:
-            return None
+        return self.avatars.get(chat.uid)
 
     def get_chat_member_picture(self, chat_member: 'ChatMember') -> BinaryIO:
-        wxid = chat_member.uid
-        result = self.bot.GetPictureBySql(wxid = wxid)
-        if result:
-            return download_file(result)
-        else:
-            return None
+        return self.avatars.get(chat_member.uid)
 
     def poll(self):
-        timer = threading.Thread(target = self.scheduled_job)
+        self.dispatcher.start()
+        self.outbound.start()
+        if self.config.get("metrics_port"):
+            metrics.serve(self.config["metrics_port"], self.config.get("metrics_host", "127.0.0.1"))
+
+        timer = threading.Thread(target = self.scheduler.run)
         timer.daemon = True
         timer.start()
 
         self.bot.run(main_thread = False)
 
-        t = threading.Thread(target = self.handle_file_msg)
+        t = threading.Thread(target = self.pending_media.run)
         t.daemon = True
         t.start()
 
@@ -861,51 +1034,134 @@ class ComWeChatChannel(SlaveChannel):
         ...
 
     def get_message_by_id(self, chat: 'Chat', msg_id: MessageID) -> Optional['Message']:
-        ...
+        entry = self.messages.get(msg_id)
+        if entry is None or entry.chat != chat.uid:
+            return None
+        if entry.author == chat.self.uid:
+            author = chat.self
+        elif "@chatroom" in chat.uid:
+            author = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
+                uid = entry.author,
+                name = entry.author_name,
+            ))
+        else:
+            author = chat.other
+        return Message(
+            uid = MessageID(entry.msgid),
+            chat = chat,
+            author = author,
+            type = MsgType.__members__.get(entry.efb_type, MsgType.Text),
+            text = entry.text,
+            deliver_to = coordinator.master,
+            vendor_specific = {"wx_xml": entry.xml or "", "comwechat_info": entry.info or {"type": entry.wx_type}},
+        )
 
     def get_name_by_wxid(self, wxid):
-        try:
-            name = self.contacts[wxid]
-            if name == "":
-                name = wxid
-        except:
-            data = self.bot.GetContactBySql(wxid = wxid)
-            if data:
-                name = data[3]
-                if name == "":
-                    name = wxid
-            else:
-                name = wxid
-        return name
+        with metrics.timed("comwechat_name_resolution_seconds"):
+            name = self.contacts.get(wxid)
+            if name is None:
+                name = self.name_resolver.resolve(wxid)
+        return name or wxid
 
     #定时更新 Start
-    def GetContactListBySql(self):
-        self.groups = []
-        self.friends = []
-        contacts = self.bot.GetContactListBySql()
-        for contact in contacts:
-            data = contacts[contact]
-            name = (f"{data['remark']}({data['nickname']})") if data["remark"] else data["nickname"]
-
-            self.contacts[contact] = name
-            if data["type"] == 0 or data["type"] == 4:
+    def GetContactListBySql(self) -> bool:
+        """
+        与上次的联系人快照比较，只处理新增、删除、改名的联系人，并将变化通知 master
+        :return: 联系人是否有变化
+        """
+        with self.contacts_lock:
+            contacts = self.bot.GetContactListBySql()
+            snapshot = {wxid : (data["remark"], data["nickname"], data["type"]) for wxid, data in contacts.items()}
+            previous = self.contact_snapshot
+            new_chats, removed_chats, modified_chats = [], [], []
+            # 注册表须容纳全部联系人，外加临时构建的群聊和系统会话，否则全量刷新时会反复淘汰、重建
+            ChatMgr.cache_size = max(self.chat_cache_size, len(snapshot) + 1024)
+            # 在副本上修改后整体替换，其他线程遍历的旧表不受影响
+            names, friends, groups = dict(self.contacts), dict(self.friends), dict(self.groups)
+
+            for wxid in previous.keys() - snapshot.keys():
+                names.pop(wxid, None)
+                if groups.pop(wxid, None) or friends.pop(wxid, None):
+                    removed_chats.append(wxid)
+                ChatMgr.invalidate(wxid)
+
+            for wxid, data in snapshot.items():
+                if previous.get(wxid) == data:
+                    continue
+                remark, nickname, contact_type = data
+                name = f"{remark}({nickname})" if remark else nickname
+                names[wxid] = name
+
+                chats = groups if "@chatroom" in wxid else friends
+                existed = wxid in chats
+                if contact_type == 0 or contact_type == 4:
+                    if chats.pop(wxid, None):
+                        removed_chats.append(wxid)
+                    continue
+
+                if "@chatroom" in wxid:
+                    chats[wxid] = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
+                        uid=wxid,
+                        name=name
+                    ))
+                else:
+                    chats[wxid] = ChatMgr.build_efb_chat_as_private(EFBPrivateChat(
+                        uid=wxid,
+                        name=name
+                    ))
+                (modified_chats if existed else new_chats).append(wxid)
+
+            self.contact_snapshot = snapshot
+            if not (new_chats or removed_chats or modified_chats):
+                return False
+            self.contacts, self.friends, self.groups = names, friends, groups
+            self.chats = tuple(groups.values()) + tuple(friends.values())
+        self.logger.debug(f"contacts updated: {len(new_chats)} new, {len(removed_chats)} removed, {len(modified_chats)} modified")
+        if previous and coordinator.master:
+            try:
+                coordinator.send_status(ChatUpdates(
+                    channel=self,
+                    new_chats=new_chats,
+                    removed_chats=removed_chats,
+                    modified_chats=modified_chats,
+                ))
+            except Exception as e:
+                self.logger.warning(f"Failed to send chat updates to master. {e}")
+        return True
+
+    def GetContactNamesBySql(self, wxids : List[str]) -> Dict[str, str]:
+        """
+        一次查询多个联系人的昵称 { "wxID" : "nickname"}
+        """
+        names = {}
+        openim = [wxid for wxid in wxids if wxid.endswith("@openim")]
+        others = [wxid for wxid in wxids if not wxid.endswith("@openim")]
+        for db_name, table, batch in (("MicroMsg.db", "Contact", others), ("OpenIMContact.db", "OpenIMContact", openim)):
+            if not batch:
                 continue
-
-            if "@chatroom" in contact:
-                new_entity = EFBGroupChat(
-                    uid=contact,
-                    name=name
-                )
-                self.groups.append(ChatMgr.build_efb_chat_as_group(new_entity))
-            else:
-                new_entity = EFBPrivateChat(
-                    uid=contact,
-                    name=name
-                )
-                self.friends.append(ChatMgr.build_efb_chat_as_private(new_entity))
-
-    def GetGroupListBySql(self):
-        self.group_members = self.bot.GetAllGroupMembersBySql()
+            in_list = ",".join("'%s'" % wxid.replace("'", "''") for wxid in batch)
+            sql = f"select UserName,NickName from {table} where UserName in ({in_list});"
+            result = self.bot.QueryDatabase(db_handle=self.bot.GetDBHandle(db_name), sql=sql)["data"]
+            for row in result[1:]:
+                if row[1]:
+                    names[row[0]] = row[1]
+        return names
+
+    def GetGroupMembersBySql(self, group_id : str) -> Dict[str, str]:
+        """
+        只读取单个群的成员昵称 { "wxID" : "displayName"}
+        """
+        sql = f"select ChatRoomName,RoomData from ChatRoom where ChatRoomName='{group_id}'"
+        result = self.bot.QueryDatabase(db_handle=self.bot.GetDBHandle(), sql=sql)["data"]
+        group_member = {}
+        if len(result) < 2:
+            return group_member
+        chatroom = ChatRoomData_pb2.ChatRoomData()
+        chatroom.ParseFromString(bytes(base64.b64decode(result[1][1])))
+        for k in chatroom.members:
+            if k.displayName != "":
+                group_member[k.wxID] = k.displayName
+        return group_member
     #定时更新 End
 
 
@@ -49,3 +49,10 @@ QUOTE_MESSAGE="""<msg>
     </appinfo>
 </msg>
 """
+
+# 群成员变动的系统消息关键字，收到后刷新该群的成员表
+MEMBER_CHANGE_KEYWORDS = (
+    "加入了群聊", "加入群聊", "移出了群聊", "移出群聊", "退出了群聊",
+    "joined the group chat", "to the group chat", "from the group chat", "left the group chat",
+    "delchatroommember",
+)
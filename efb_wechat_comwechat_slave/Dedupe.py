@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from math import ceil, log
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+ENTRY_COST = 160    # 精确集合中每条记录的估算内存占用（字节）
+
+
+class BloomFilter:
+    def __init__(self, size_bytes: int, error_rate: float):
+        self.size = max(size_bytes, 1) * 8
+        self.capacity = max(int(self.size * log(2) ** 2 / -log(error_rate)), 1)
+        self.hashes = max(round(self.size / self.capacity * log(2)), 1)
+        self.bits = bytearray(ceil(self.size / 8))
+
+    def _indexes(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key))
+
+
+class MessageDeduplicator:
+    """
+    消息去重
+    两代轮换的 Bloom filter 覆盖整个去重窗口，其后是按内存预算限制大小的精确集合，可选 SQLite 持久化。
+    Bloom filter 未命中即为新消息；命中时由精确集合或 SQLite 确认，二者都无法确认时信任 Bloom filter。
+    记录至少保留 ttl 秒，至多 2 * ttl 秒。
+    """
+
+    def __init__(self, ttl: int = 3600, memory_budget: int = 4 * 1024 * 1024,
+                 error_rate: float = 1e-6, db_path: Optional[str] = None):
+        """
+        :param ttl: 去重窗口（秒）
+        :param memory_budget: 内存预算（字节），一半给两代 Bloom filter，一半给精确集合
+        :param error_rate: 单代 Bloom filter 满载时的误判率
+        :param db_path: SQLite 文件路径，为 None 时不持久化
+        """
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.bloom_size = max(memory_budget // 4, 1)
+        self.exact_capacity = max(memory_budget // 2 // ENTRY_COST, 1)
+
+        self.current = BloomFilter(self.bloom_size, error_rate)
+        self.previous = BloomFilter(self.bloom_size, error_rate)
+        self.rotated_at = time.time()
+        self.exact: OrderedDict = OrderedDict()     # {key : timestamp}
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._open_db(db_path)
+
+    @staticmethod
+    def make_key(msgid, msg_type) -> str:
+        return f"{msgid}:{msg_type}"
+
+    def seen(self, msgid, msg_type) -> bool:
+        """
+        检查并记录消息，重复消息返回 True
+        """
+        key = self.make_key(msgid, msg_type)
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if (key in self.current or key in self.previous) and self._confirm(key):
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.current.add(key)
+            self.exact[key] = now
+            if len(self.exact) > self.exact_capacity:
+                self.exact.popitem(last=False)
+            if self.db is not None:
+                try:
+                    self.db.execute("INSERT OR REPLACE INTO seen (key, ts) VALUES (?, ?)", (key, now))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to persist dedupe key {key}. {e}")
+            return False
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def _confirm(self, key: str) -> bool:
+        if key in self.exact:
+            return True
+        if self.db is not None:
+            try:
+                return self.db.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone() is not None
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to query dedupe key {key}. {e}")
+        return True
+
+    def _expire(self, now: float):
+        while self.exact:
+            key, ts = next(iter(self.exact.items()))
+            if now - ts <= self.ttl:
+                break
+            self.exact.popitem(last=False)
+
+        if now - self.rotated_at < self.ttl:
+            return
+        self.previous = self.current
+        self.current = BloomFilter(self.bloom_size, self.error_rate)
+        self.rotated_at = now
+        if self.db is not None:
+            try:
+                self.db.execute("DELETE FROM seen WHERE ts < ?", (now - 2 * self.ttl,))
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to compact dedupe store. {e}")
+
+    def _open_db(self, db_path: str):
+        try:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, ts REAL NOT NULL)")
+            now = time.time()
+            self.db.execute("DELETE FROM seen WHERE ts < ?", (now - 2 * self.ttl,))
+            self.db.commit()
+            for key, ts in self.db.execute("SELECT key, ts FROM seen"):
+                (self.current if now - ts <= self.ttl else self.previous).add(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to open dedupe store {db_path}, persistence disabled. {e}")
+            self.db = None
@@ -0,0 +1,85 @@
+import logging
+import queue
+import threading
+import zlib
+from functools import wraps
+from typing import Callable, Dict, List, Any
+
+logger = logging.getLogger(__name__)
+
+
+class ChatDispatcher:
+    """
+    按聊天分片的工作线程池
+    同一聊天的任务总是落在同一个队列上，保证聊天内顺序；不同聊天由不同线程并行处理
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000, name: str = "dispatcher"):
+        """
+        :param workers: 工作线程数量，为 0 时在调用线程上直接执行
+        :param queue_size: 每个分片队列的最大长度，队列满时阻塞提交方
+        :param name: 线程名前缀
+        """
+        self.workers = max(int(workers), 0)
+        self.queue_size = max(int(queue_size), 0)
+        self.name = name
+        self.queues: List[queue.Queue] = []
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        if self.queues or not self.workers:
+            return
+        for index in range(self.workers):
+            q = queue.Queue(maxsize=self.queue_size)
+            t = threading.Thread(target=self._worker, args=(q,), name=f"{self.name}-{index}")
+            t.daemon = True
+            self.queues.append(q)
+            self.threads.append(t)
+            t.start()
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        self.queues = []
+        self.threads = []
+
+    def shard(self, key: str) -> int:
+        return zlib.crc32(str(key).encode("utf-8")) % len(self.queues)
+
+    def submit(self, key: str, func: Callable, *args, **kwargs):
+        """
+        提交任务到 key 对应的分片队列
+        :param key: 分片键，一般为聊天 uid
+        """
+        if not self.queues:
+            return func(*args, **kwargs)
+        q = self.queues[self.shard(key)]
+        task = (func, args, kwargs)
+        try:
+            q.put_nowait(task)
+        except queue.Full:
+            logger.warning(f"Dispatch queue for {key} is full ({self.queue_size}), waiting for workers.")
+            q.put(task)
+
+    def by_chat(self, func: Callable[[Dict], Any]) -> Callable[[Dict], None]:
+        """
+        回调装饰器，按 msg["sender"] 分片执行
+        """
+        @wraps(func)
+        def wrapper(msg: Dict):
+            self.submit(msg.get("sender", ""), func, msg)
+        return wrapper
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def _worker(self, q: queue.Queue):
+        while True:
+            task = q.get()
+            if task is None:
+                break
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception(f"Error occurred when handling task {getattr(func, '__name__', func)}")
@@ -0,0 +1,91 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class GroupRoster:
+    """
+    按群懒加载的群成员昵称表 {"group_id" : { "wxID" : "displayName"}}
+    首次访问时同步加载单个群，过期后返回旧数据并在后台刷新；按成员总数做 LRU 淘汰
+    """
+
+    def __init__(self, loader: Callable[[str], Dict[str, str]], max_members: int = 50000, ttl: int = 1800):
+        """
+        :param loader: 加载单个群成员昵称的函数 loader(group_id) -> {wxid : displayName}
+        :param max_members: 缓存的成员总数上限
+        :param ttl: 群成员表过期时间（秒），过期后在后台刷新
+        """
+        self.loader = loader
+        self.max_members = max_members
+        self.ttl = ttl
+
+        self.rosters: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self.loaded_at: Dict[str, float] = {}
+        self.size = 0
+
+        self.lock = threading.Lock()
+        self.refresh_queue: queue.Queue = queue.Queue()
+        self.refreshing: Set[str] = set()
+        self.worker: Optional[threading.Thread] = None
+
+    def get(self, group_id: str) -> Dict[str, str]:
+        """
+        获取群成员昵称表，未加载时同步加载
+        """
+        with self.lock:
+            roster = self.rosters.get(group_id)
+            if roster is not None:
+                self.rosters.move_to_end(group_id)
+                stale = time.monotonic() - self.loaded_at[group_id] > self.ttl
+        if roster is None:
+            return self.load(group_id)
+        if stale:
+            self.refresh(group_id)
+        return roster
+
+    def load(self, group_id: str) -> Dict[str, str]:
+        try:
+            roster = self.loader(group_id) or {}
+        except Exception as e:
+            logger.warning(f"Failed to load members of {group_id}. {e}")
+            return {}
+        with self.lock:
+            self.size -= len(self.rosters.pop(group_id, ()))
+            self.rosters[group_id] = roster
+            self.loaded_at[group_id] = time.monotonic()
+            self.size += len(roster)
+            while self.size > self.max_members and len(self.rosters) > 1:
+                evicted, members = self.rosters.popitem(last=False)
+                self.loaded_at.pop(evicted, None)
+                self.size -= len(members)
+        return roster
+
+    def refresh(self, group_id: str):
+        """
+        在后台重新加载某个群，用于过期或收到成员变动消息时
+        """
+        with self.lock:
+            if group_id in self.refreshing:
+                return
+            self.refreshing.add(group_id)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._refresh_loop, name="group-roster")
+                self.worker.daemon = True
+                self.worker.start()
+        self.refresh_queue.put(group_id)
+
+    def snapshot(self) -> Dict[str, Dict[str, str]]:
+        with self.lock:
+            return dict(self.rosters)
+
+    def _refresh_loop(self):
+        while True:
+            group_id = self.refresh_queue.get()
+            with self.lock:
+                self.refreshing.discard(group_id)
+            self.load(group_id)
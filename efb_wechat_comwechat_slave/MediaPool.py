@@ -0,0 +1,117 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional
+
+from .Metrics import metrics
+from .Tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class MediaPool:
+    """
+    CPU 密集的媒体任务（图片解码、SILK 解码、音频转码、二维码识别）的共享进程池
+    避免在回调线程或 master 线程上占用 GIL；任务函数和参数需可 pickle，通常以文件路径进出
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 60):
+        """
+        :param workers: 进程数，为 0 时在调用线程中直接执行
+        :param timeout: 默认等待超时（秒）
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.timings: Dict[str, List[float]] = {}    # {task : [count, failures, timeouts, total seconds, max seconds]}
+        self.lock = threading.Lock()
+
+    def configure(self, workers: int = 2, timeout: float = 60):
+        with self.lock:
+            executor, self.executor = self.executor, None
+            self.workers = workers
+            self.timeout = timeout
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def submit(self, task: str, func: Callable, *args) -> Future:
+        """
+        :param task: 任务类型，用于统计耗时
+        """
+        begin = time.monotonic()
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self._executor().submit(func, *args)
+        future.add_done_callback(lambda f: self._record(task, begin, f))
+        return future
+
+    def run(self, task: str, func: Callable, *args, timeout: Optional[float] = None) -> Any:
+        """
+        提交任务并等待结果，超时抛出 concurrent.futures.TimeoutError（子进程中的任务不会被中断）
+        """
+        with tracer.span(f"media_pool.{task}"):
+            return self._wait(task, self.submit(task, func, *args), timeout)
+
+    def _wait(self, task: str, future: Future, timeout: Optional[float]) -> Any:
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            with self.lock:
+                self._timing(task)[2] += 1
+            logger.warning(f"Media task {task} timed out")
+            raise
+        except BrokenProcessPool:
+            self._reset()
+            raise
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {
+                task: {
+                    "count": count, "failures": failures, "timeouts": timeouts,
+                    "avg": total / count if count else 0.0, "max": maximum,
+                }
+                for task, (count, failures, timeouts, total, maximum) in self.timings.items()
+            }
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # 回调线程众多，fork 子进程可能继承被占用的锁
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            return self.executor
+
+    def _reset(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _timing(self, task: str) -> List[float]:
+        return self.timings.setdefault(task, [0, 0, 0, 0.0, 0.0])
+
+    def _record(self, task: str, begin: float, future: Future):
+        elapsed = time.monotonic() - begin
+        with self.lock:
+            timing = self._timing(task)
+            timing[0] += 1
+            timing[1] += 1 if future.cancelled() or future.exception() is not None else 0
+            timing[3] += elapsed
+            timing[4] = max(timing[4], elapsed)
+        metrics.observe("comwechat_media_seconds", elapsed, task=task)
+        logger.debug(f"media task {task} took {elapsed:.3f}s")
+
+
+media_pool = MediaPool()
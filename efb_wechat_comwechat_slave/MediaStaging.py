@@ -0,0 +1,128 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, BinaryIO, Dict, List
+
+from ehforwarderbot.exceptions import EFBMessageError
+
+from .Metrics import metrics
+from .Utils import stream_copy
+
+logger = logging.getLogger(__name__)
+
+OUTBOX = "efb_outbox"
+
+
+class MediaStager:
+    """
+    将 master 发来的文件放入 WeChat 可访问的共享目录
+    同一文件系统时直接硬链接到最终文件名，否则在内核中流式复制；按磁盘配额限制暂存区总大小
+    每次暂存放入独立的子目录，并发发送的同名文件互不覆盖，微信中显示的文件名不变
+    """
+
+    def __init__(self, directory: str, quota: int = 2 * 1024 ** 3):
+        """
+        :param directory: 暂存目录，即 {dir}{wxid}/
+        :param quota: 暂存区总大小上限（字节）
+        """
+        self.directory = directory
+        self.quota = quota
+        self.files: Dict[str, int] = {}       # {path : size}
+        self.used = 0
+        self.timings: Dict[str, List[float]] = {}    # {stage : [count, total seconds, last seconds]}
+        self.lock = threading.Lock()
+
+    def stage(self, file: BinaryIO, name: str) -> str:
+        """
+        :param file: master 发来的文件
+        :param name: 共享目录中的文件名
+        :return: 暂存后的本地路径，位于 directory 下的 OUTBOX/<uuid>/name
+        """
+        with self.timed("stage"):
+            size = os.fstat(file.fileno()).st_size
+            path = os.path.join(self.directory, OUTBOX, uuid.uuid4().hex, os.path.basename(name))
+            with self.lock:
+                self._reclaim()
+                needed = self.used - self.files.get(path, 0) + size
+                if needed > self.quota:
+                    raise EFBMessageError(f"暂存区已满 ({needed} > {self.quota} bytes)，请稍后重试")
+                self.used += size
+
+            try:
+                os.makedirs(os.path.dirname(path))
+                self._place(file, path)
+            except Exception:
+                with self.lock:
+                    self.used -= size
+                self._remove_dir(path)
+                raise
+            with self.lock:
+                self.files[path] = size
+        return path
+
+    def relpath(self, path: str) -> str:
+        """
+        :return: 暂存文件相对 directory 的路径，用于拼接 WeChat 一侧的路径
+        """
+        return os.path.relpath(path, self.directory)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - begin
+            with self.lock:
+                timing = self.timings.setdefault(stage, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = elapsed
+            metrics.observe("comwechat_outbound_media_seconds", elapsed, stage=stage)
+            logger.debug(f"outbound media {stage} took {elapsed:.3f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {
+                stage: {"count": count, "avg": total / count if count else 0.0, "last": last}
+                for stage, (count, total, last) in self.timings.items()
+            }
+            return {"used": self.used, "quota": self.quota, "files": len(self.files), "stages": stages}
+
+    def _place(self, file: BinaryIO, path: str):
+        tmp_path = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}.tmp")
+        source = getattr(file, "name", None)
+        try:
+            if isinstance(source, str) and os.path.exists(source) \
+                    and os.path.samestat(os.stat(source), os.fstat(file.fileno())):
+                os.link(source, tmp_path)
+                os.replace(tmp_path, path)
+                # 目标已是同一文件的硬链接时 rename 不做任何事，需手动清理
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+                return
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+        try:
+            with open(tmp_path, "wb") as f:
+                stream_copy(file, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def _reclaim(self):
+        # 已发送的文件由 PendingMediaTracker 延迟删除，这里释放配额并清理空的子目录
+        for path in [path for path in self.files if not os.path.exists(path)]:
+            self.used -= self.files.pop(path)
+            self._remove_dir(path)
+
+    @staticmethod
+    def _remove_dir(path: str):
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(path))
@@ -0,0 +1,182 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class IndexedMessage:
+    """
+    已投递到 master 的微信消息摘要
+    """
+    __slots__ = ("msgid", "chat", "author", "author_name", "wx_type", "efb_type", "text", "xml", "info", "ts", "pinned")
+
+    def __init__(self, msgid: str, chat: str, author: str, author_name: str, wx_type: str,
+                 efb_type: str, text: str, xml: Optional[str], info: Optional[Dict[str, Any]], ts: float,
+                 pinned: bool = False):
+        self.msgid = msgid
+        self.chat = chat
+        self.author = author
+        self.author_name = author_name
+        self.wx_type = wx_type          # ComWeChat 回调中的 type，如 text、share
+        self.efb_type = efb_type        # MsgType 名称
+        self.text = text
+        self.xml = xml
+        self.info = info                # 回调原始字段（不含 message），即原 comwechat_info
+        self.ts = ts
+        self.pinned = pinned            # 按 pinned_ttl 清理
+
+
+class MessageIndex:
+    """
+    微信 msgid -> 聊天、发送者、类型、原始 xml 和回调字段的本地索引
+    SQLite 按主键查询，最近的消息保存在内存环中；xml 和回调字段压缩存放，压缩后仍过大的 xml 不保存。
+    记录保留 ttl 秒，由 compact 清理；pinned 的记录（slim_vendor_specific 时 master 只能从索引取回原始内容）保留更长的 pinned_ttl 秒
+    """
+
+    def __init__(self, db_path: str, ttl: float = 7 * 86400, hot_size: int = 2048, max_xml: int = 64 * 1024,
+                 pinned_ttl: float = 90 * 86400):
+        """
+        :param db_path: SQLite 文件路径
+        :param ttl: 记录保留时间（秒）
+        :param pinned_ttl: pinned 记录的保留时间（秒），不短于 ttl
+        :param hot_size: 内存中保留的最近消息数
+        :param max_xml: 保存的 xml 最大字节数（压缩后），超出时只保存文本
+        """
+        self.ttl = ttl
+        self.pinned_ttl = max(pinned_ttl, ttl)
+        self.hot_size = max(int(hot_size), 0)
+        self.max_xml = max_xml
+        self.hot: OrderedDict = OrderedDict()      # {msgid : IndexedMessage}
+        self.lock = threading.Lock()
+
+        self.db: Optional[sqlite3.Connection] = None
+        self._open_db(db_path)
+
+    def record(self, msgid, chat: str, author: str, author_name: str, wx_type: str,
+               efb_type: str, text: str, xml: Optional[str], info: Optional[Dict[str, Any]] = None,
+               pinned: bool = False):
+        msgid = str(msgid)
+        packed = zlib.compress(xml.encode("utf-8")) if xml else None
+        if packed and len(packed) > self.max_xml:
+            logger.debug(f"XML of message {msgid} is {len(packed)} bytes compressed, only text is indexed")
+            xml = packed = None
+        entry = IndexedMessage(msgid, chat, author, author_name, wx_type, efb_type, text or "", xml or None, info,
+                               time.time(), pinned)
+        with self.lock:
+            self._remember(entry)
+            if self.db is None:
+                return
+            try:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO messages (msgid, chat, author, author_name, wx_type, efb_type, text, xml, info, ts, pinned)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (msgid, chat, author, author_name, wx_type, efb_type, entry.text, packed,
+                     zlib.compress(json.dumps(info, ensure_ascii=False).encode("utf-8")) if info else None,
+                     entry.ts, int(pinned)),
+                )
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to index message {msgid}. {e}")
+
+    def get(self, msgid) -> Optional[IndexedMessage]:
+        msgid = str(msgid)
+        with self.lock:
+            entry = self.hot.get(msgid)
+            if entry is not None:
+                self.hot.move_to_end(msgid)
+                return entry
+            if self.db is None:
+                return None
+            try:
+                row = self.db.execute(
+                    "SELECT msgid, chat, author, author_name, wx_type, efb_type, text, xml, info, ts, pinned"
+                    " FROM messages WHERE msgid = ? AND (ts >= ? OR (pinned AND ts >= ?))",
+                    (msgid, time.time() - self.ttl, time.time() - self.pinned_ttl),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to look up message {msgid}. {e}")
+                return None
+            if row is None:
+                return None
+            xml = zlib.decompress(row[7]).decode("utf-8") if row[7] else None
+            info = json.loads(zlib.decompress(row[8])) if row[8] else None
+            entry = IndexedMessage(*row[:7], xml, info, row[9], bool(row[10]))
+            self._remember(entry)
+            return entry
+
+    def __contains__(self, msgid) -> bool:
+        return self.get(msgid) is not None
+
+    def forget(self, msgid):
+        msgid = str(msgid)
+        with self.lock:
+            self.hot.pop(msgid, None)
+            if self.db is None:
+                return
+            try:
+                self.db.execute("DELETE FROM messages WHERE msgid = ?", (msgid,))
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to remove message {msgid} from index. {e}")
+
+    def compact(self) -> bool:
+        """
+        清理过期记录，供 Scheduler 定期调用
+        :return: 是否清理了记录
+        """
+        now = time.time()
+        deadline, pinned_deadline = now - self.ttl, now - self.pinned_ttl
+        with self.lock:
+            for msgid in [msgid for msgid, entry in self.hot.items()
+                          if entry.ts < (pinned_deadline if entry.pinned else deadline)]:
+                del self.hot[msgid]
+            if self.db is None:
+                return False
+            try:
+                removed = self.db.execute("DELETE FROM messages WHERE ts < ? AND (NOT pinned OR ts < ?)",
+                                          (deadline, pinned_deadline)).rowcount
+                self.db.commit()
+                if removed:
+                    self.db.execute("PRAGMA incremental_vacuum")
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to compact message index. {e}")
+                return False
+        logger.debug(f"Removed {removed} expired messages from index")
+        return removed > 0
+
+    def _remember(self, entry: IndexedMessage):
+        if not self.hot_size:
+            return
+        self.hot[entry.msgid] = entry
+        self.hot.move_to_end(entry.msgid)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def _open_db(self, db_path: str):
+        try:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")     # 只对新建的库生效
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "msgid TEXT PRIMARY KEY, chat TEXT NOT NULL, author TEXT NOT NULL, author_name TEXT, "
+                "wx_type TEXT, efb_type TEXT, text TEXT, xml BLOB, info BLOB, ts REAL NOT NULL, "
+                "pinned INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+            if "info" not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN info BLOB")
+            if "pinned" not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)")
+            self.db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to open message index {db_path}, only recent messages are kept. {e}")
+            self.db = None
@@ -0,0 +1,144 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 秒，覆盖从毫秒级的解析到分钟级的媒体等待
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    """
+    进程内的计数器、直方图和仪表，以 Prometheus 文本格式导出
+    记录只在内存中累加；配置了端口时由本地 HTTP 服务提供 /metrics
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        :param buckets: 直方图桶上界（秒）
+        """
+        self.buckets = buckets
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, List[float]]] = {}     # {name : {labels : [每个桶的计数..., +Inf 计数, sum]}}
+        self.gauges: Dict[str, Callable[[], Union[float, Dict[Labels, float]]]] = {}
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            counts[-1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, name: str, **labels):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - begin, **labels)
+
+    def gauge(self, name: str, func: Callable[[], Union[float, Dict[Labels, float]]]):
+        """
+        注册仪表，导出时调用 func 取值
+        :param func: 返回数值，或 {labels : 数值}
+        """
+        with self.lock:
+            self.gauges[name] = func
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {k: list(v) for k, v in series.items()} for name, series in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, counts in series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        for name, func in sorted(gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"Failed to read gauge {name}. {e}")
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            series = value if isinstance(value, dict) else {(): value}
+            for labels, v in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {float(v)}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        在后台线程上启动 /metrics 服务
+        """
+        if self.server is not None:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        t = threading.Thread(target=self.server.serve_forever, name="metrics")
+        t.daemon = True
+        t.start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+metrics = Metrics()
@@ -1,6 +1,7 @@
-from typing import Mapping, Tuple, List, Union, IO
+from typing import Mapping, Tuple, List, Union, IO, Iterable, Iterator
 import magic
 from lxml import etree
+from contextlib import closing
 from functools import partial
 from traceback import print_exc
 import re , json
@@ -12,71 +13,121 @@ from ehforwarderbot.types import MessageID
 
 from .ChatMgr import ChatMgr
 from .CustomTypes import EFBGroupChat, EFBPrivateChat
+from .AppMsg import (AppMsg, first, required, XPATH_ITEMS, XPATH_PUBLISHER_NICKNAME, XPATH_SPORT_RANK,
+                     XPATH_SPORT_SCORE, XPATH_WEAPP_ICON_URL, XPATH_FINDER_FEED_AVATAR, XPATH_FINDER_FEED_DESC,
+                     XPATH_FINDER_LIVE_HEAD_URL, XPATH_FINDER_LIVE_DESC, XPATH_PAY_SUBTYPE, XPATH_PAY_FEEDESC,
+                     XPATH_RECORD_DATADESC)
+from .SafeXml import XmlLimitExceeded, iter_xml_elements, parse_xml
+from .Utils import convert_wc_emoticons
 
 QUOTE_DIVIDER = " - - - - - - - - - - - - - - - "
+OVERSIZE_PLACEHOLDER = "[消息内容过大或嵌套过深，请在手机端查看]"
+CHAT_HISTORY_MAX_ITEMS = 500        # 合并转发的聊天记录最多展示的条数（含嵌套）
+CHAT_HISTORY_MAX_DEPTH = 4          # 最多展开的嵌套层数
+CHAT_HISTORY_MAX_CHARS = 4000       # 每条消息的最大字符数，超出时拆分为多条
+
+def configure_chat_history(max_items: int = 500, max_depth: int = 4, max_chars: int = 4000):
+    """
+    设置合并转发聊天记录的展示上限
+    :param max_items: 最多展示的条数（含嵌套）
+    :param max_depth: 最多展开的嵌套层数
+    :param max_chars: 每条消息的最大字符数
+    """
+    global CHAT_HISTORY_MAX_ITEMS, CHAT_HISTORY_MAX_DEPTH, CHAT_HISTORY_MAX_CHARS
+    CHAT_HISTORY_MAX_ITEMS = max(int(max_items), 1)
+    CHAT_HISTORY_MAX_DEPTH = max(int(max_depth), 1)
+    CHAT_HISTORY_MAX_CHARS = max(int(max_chars), 256)
 
 def qutoed_text(qutoed_text: str, text: str, prefix: str = "") -> str:
     if QUOTE_DIVIDER in qutoed_text:
         qutoed_text = qutoed_text.split(QUOTE_DIVIDER)[-1]
     return f"「{prefix}{qutoed_text}」\n{QUOTE_DIVIDER}\n{text}"
 
-def parse_chat_history(xml, level: int = 1) -> list[dict]:
-    res = []
-    datalist_element = xml.find('.//datalist')
-    if datalist_element is not None:
-        for dataitem in datalist_element.findall('dataitem'):
-            #TODO 想办法下载图片文件等
-            data = {
-                'datatype': dataitem.get('datatype'),
-                # 'dataid': dataitem.get('dataid'),
-                # 'messageuuid': dataitem.find('.//messageuuid').text if dataitem.find('.//messageuuid') is not None else '',
-                # 'cdnthumburl': dataitem.find('.//cdnthumburl').text if dataitem.find('.//cdnthumburl') is not None else '',
-                'datatitle': dataitem.find('.//datatitle').text if dataitem.find(
-                    './/datatitle') is not None else '',
-                'sourcetime': dataitem.find('.//sourcetime').text if dataitem.find(
-                    './/sourcetime') is not None else '',
-                # 'fromnewmsgid': dataitem.find('.//fromnewmsgid').text if dataitem.find('.//fromnewmsgid') is not None else '',
-                # 'datasize': dataitem.find('.//datasize').text if dataitem.find('.//datasize') is not None else '',
-                # 'thumbfullmd5': dataitem.find('.//thumbfullmd5').text if dataitem.find('.//thumbfullmd5') is not None else '',
-                'datafmt': dataitem.find('.//datafmt').text if dataitem.find(
-                    './/datafmt') is not None else '',
-                # 'cdnthumbkey': dataitem.find('.//cdnthumbkey').text if dataitem.find('.//cdnthumbkey') is not None else '',
-                'sourcename': dataitem.find('.//sourcename').text if dataitem.find(
-                    './/sourcename') is not None else '',
-                'sourceheadurl': dataitem.find('.//sourceheadurl').text if dataitem.find(
-                    './/sourceheadurl') is not None else '',
-                'datadesc': dataitem.find('.//datadesc').text if dataitem.find(
-                    './/datadesc') is not None else '',
-                'children': [],
-            }
-
-            prefix = f"{data['sourcename']}: "
-            count = 8 * level
-            if data['datatype'] == '1':
-                data['placeholder'] = data['datadesc']
-            elif data['datatype'] == '2':
-                data['placeholder'] = '[Photo]'
-            elif data['datatype'] == '4':
-                data['placeholder'] = '[Video]'
-            elif data['datatype'] == '5':
-                data['placeholder'] = f"[Link] {data['datatitle']}"
-            elif data['datatype'] == '8':
-                data['placeholder'] = f"[File] {data['datatitle']}"
-            elif data['datatype'] == '17':
-                data['placeholder'] = f"\n{' ' * count}[Chat History]"
-                for i in parse_chat_history(dataitem.find('recordxml/recordinfo'), level + 1):
-                    data['placeholder'] += f"\n{' ' * count}{i['formatted']}"
-                    data['children'] = i
-                data['placeholder'] += f"\n{' ' * count}[Chat History]"
-            elif data['datatype'] == '19':
-                data['placeholder'] = f"[Mini Program] {data['datatitle']}"
-            else:
-                data['placeholder'] = data['datadesc'] or data['datatitle']
-
-            data['formatted'] = f"{prefix} {data['placeholder']}"
-
-            res.append(data)
-    return res
+def _history_placeholder(datatype: str, title: str, desc: str) -> str:
+    if datatype == '1':
+        return desc
+    elif datatype == '2':
+        return '[Photo]'
+    elif datatype == '4':
+        return '[Video]'
+    elif datatype == '5':
+        return f"[Link] {title}"
+    elif datatype == '8':
+        return f"[File] {title}"
+    elif datatype == '19':
+        return f"[Mini Program] {title}"
+    return desc or title
+
+def _render_history_item(dataitem, level: int, budget: list) -> Iterator[str]:
+    """
+    渲染一条聊天记录，第一行不含缩进，嵌套记录的后续行已带缩进
+    """
+    #TODO 想办法下载图片文件等
+    budget[0] -= 1
+    datatype = dataitem.get('datatype')
+    prefix = f"{dataitem.findtext('sourcename') or ''}: "
+    if datatype != '17':
+        title = convert_wc_emoticons(dataitem.findtext('datatitle') or '')
+        desc = convert_wc_emoticons(dataitem.findtext('datadesc') or '')
+        yield f"{prefix} {_history_placeholder(datatype, title, desc)}"
+        return
+    if level >= CHAT_HISTORY_MAX_DEPTH:
+        budget[1] = True
+        yield f"{prefix} [Chat History]"
+        return
+
+    indent = ' ' * (8 * level)
+    yield f"{prefix} "
+    yield f"{indent}[Chat History]"
+    recordinfo = dataitem.find('recordxml/recordinfo')
+    datalist = recordinfo.find('.//datalist') if recordinfo is not None else None
+    for child in (datalist.iterfind('dataitem') if datalist is not None else ()):
+        if budget[0] <= 0:
+            budget[1] = True
+            break
+        lines = _render_history_item(child, level + 1, budget)
+        yield indent + next(lines)
+        yield from lines
+    yield f"{indent}[Chat History]"
+
+def render_chat_history(recorditem: str) -> Iterator[str]:
+    """
+    逐行渲染合并转发的聊天记录（appmsg type 19 的 recorditem）
+    增量解析，每条处理完即释放；总条数（含嵌套）和展开的嵌套层数有上限，超出部分不再解析
+    """
+    budget = [CHAT_HISTORY_MAX_ITEMS, False]    # [剩余条数, 是否有未展示的记录]
+    with closing(iter_xml_elements(recorditem, 'dataitem')) as dataitems:
+        for dataitem in dataitems:
+            if budget[0] <= 0:
+                budget[1] = True
+                break
+            yield from _render_history_item(dataitem, 1, budget)
+    if budget[1]:
+        yield "…… 其余聊天记录未展示，请在手机端查看"
+
+def split_lines(lines: Iterable[str], max_chars: int) -> Iterator[str]:
+    """
+    将多行文本按 max_chars 拼接为若干段，单行过长时拆开
+    """
+    if max_chars <= 0:
+        raise ValueError(f"max_chars must be positive, got {max_chars}")
+    chunk: List[str] = []
+    size = 0
+    for line in lines:
+        if len(line) > max_chars:
+            if chunk:
+                yield "\n".join(chunk)
+                chunk, size = [], 0
+            while len(line) > max_chars:
+                yield line[:max_chars]
+                line = line[max_chars:]
+        if chunk and size + 1 + len(line) > max_chars:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        size += len(line) + (1 if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        yield "\n".join(chunk)
 
 def efb_text_simple_wrapper(text: str, ats: Union[Mapping[Tuple[int, int], Union[Chat, ChatMember]], None] = None) -> Message:
     """
@@ -238,28 +289,32 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
     """
 
     text: str = message['message']
-    xml = etree.fromstring(text)
+    try:
+        xml = parse_xml(text)
+    except XmlLimitExceeded:
+        return efb_text_simple_wrapper(OVERSIZE_PLACEHOLDER)
+    app = AppMsg.parse(xml)
     result_text = ""
     try:
-        type = int(xml.xpath('/msg/appmsg/type/text()')[0])
+        type = app.type
         if type in [ 1 , 2 ]:
-            title = xml.xpath('/msg/appmsg/title/text()')[0]
-            des = xml.xpath('/msg/appmsg/des/text()')[0]
+            title = required(app.title)
+            des = required(app.des)
             efb_msg = Message(
                 type = MsgType.Text,
                 text = title if title==des else title+" :\n"+des,
             )
         elif type == 3: #音乐分享
             try:
-                music_name = xml.xpath('/msg/appmsg/title/text()')[0]
-                music_singer = xml.xpath('/msg/appmsg/des/text()')[0]
+                music_name = required(app.title)
+                music_singer = required(app.des)
             except:
                 efb_msg = Message(
                     type = MsgType.Text,
                     text = "- - - - - - - - - - - - - - - \n无效的音乐分享",
                 )
             try:
-                thumb_url = xml.xpath('/msg/appmsg/url/text()')[0]
+                thumb_url = required(app.url)
                 attribute = LinkAttribute(
                     title = music_name + ' / ' + music_singer,
                     description = None,
@@ -275,14 +330,11 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
             except:
                 pass
         elif type in [ 4 , 36 ]: # 至少包含小红书分享 , 京东农场 , 滴滴打车
-            title = xml.xpath('/msg/appmsg/title/text()')[0]
-            try:
-                des = xml.xpath('/msg/appmsg/des/text()')[0]
-            except:
-                des = ""
-            url = xml.xpath('/msg/appmsg/url/text()')[0]
-            app = xml.xpath('/msg/appinfo/appname/text()')[0]
-            description = f"{des}\n---- from {app}"
+            title = required(app.title)
+            des = app.des or ""
+            url = required(app.url)
+            app_name = required(app.appname)
+            description = f"{des}\n---- from {app_name}"
             attribute = LinkAttribute(
                 title = title,
                 description = description,
@@ -296,37 +348,26 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                 vendor_specific={ "is_mp": False }
             )
         elif type == 5: # xml链接
-            if len(xml.xpath('/msg/appmsg/showtype/text()'))!=0:
-                showtype = int(xml.xpath('/msg/appmsg/showtype/text()')[0])
-            else:
-                showtype = 0
+            showtype = app.showtype or 0
             if showtype == 0: # 消息对话中的(测试的是从公众号转发给好友, 不排除其他情况)
                 title = url = des = thumburl = None # 初始化
                 try:
-                    try:
-                        title = xml.xpath('/msg/appmsg/title/text()')[0]
-                    except:
-                        title = "[xml 消息解析，点击查看详情]"
+                    title = app.title or "[xml 消息解析，点击查看详情]"
                     if '<' in title and '>' in title:
                         subs = re.findall('<[\s\S]+?>', title)
                         for sub in subs:
                             title = title.replace(sub, '')
-                    url = xml.xpath('/msg/appmsg/url/text()')[0]
-                    if len(xml.xpath('/msg/appmsg/des/text()'))!=0:
-                        des = xml.xpath('/msg/appmsg/des/text()')[0]
-                    if len(xml.xpath('/msg/appmsg/thumburl/text()'))!=0:
-                        thumburl = xml.xpath('/msg/appmsg/thumburl/text()')[0]
-                    if len(xml.xpath('/msg/appinfo/appname/text()'))!=0:
-                        app = xml.xpath('/msg/appinfo/appname/text()')[0]
-                        des = f"{des}\n---- from {app}"
-
-                    if len(xml.xpath('/msg/appmsg/sourceusername/text()'))!=0:
-                        sourceusername = xml.xpath('/msg/appmsg/sourceusername/text()')[0]
-                        try:
-                            sourcedisplayname = xml.xpath('/msg/appmsg/sourcedisplayname/text()')[0]
-                            result_text += f"\n转发自公众号[{sourcedisplayname}(id: {sourceusername})]\n\n"
-                        except:
-                            result_text += f"\n转发自公众号[{sourcedisplayname}]\n\n"
+                    url = required(app.url)
+                    des = app.des
+                    thumburl = app.thumburl
+                    if app.appname is not None:
+                        des = f"{des}\n---- from {app.appname}"
+
+                    if app.sourceusername is not None:
+                        if app.sourcedisplayname is not None:
+                            result_text += f"\n转发自公众号[{app.sourcedisplayname}(id: {app.sourceusername})]\n\n"
+                        else:
+                            result_text += f"\n转发自公众号[{app.sourceusername}]\n\n"
                 except Exception as e:
                     print_exc()
                 if title is not None and url is not None:
@@ -343,8 +384,8 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                         vendor_specific={ "is_mp": True }
                     )
             elif showtype == 1: # 公众号发的推送
-                items = xml.xpath('//item')
-                show_name = xml.xpath('//publisher/nickname/text()')[0] if '@app' in text else ''
+                items = XPATH_ITEMS(xml)
+                show_name = XPATH_PUBLISHER_NICKNAME(xml)[0] if '@app' in text else ''
                 efb_msg = list(map(partial(efb_mp_post_wrapper, show_name=show_name), items))
         elif type == 8:
             efb_msg = Message(
@@ -352,35 +393,34 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                 text='未解密表情消息 ，请在手机端查看',
             )
         elif type == 17:
-            msg_title = xml.xpath('/msg/appmsg/title/text()')[0]
+            msg_title = required(app.title)
             efb_msg = Message(
                 type=MsgType.Text,
                 text=msg_title,
             )
         elif type == 19: # 合并转发的聊天记录
+            msg_title = app.title or ""
+            max_title = CHAT_HISTORY_MAX_CHARS // 4       # 标题由发送者决定，截断后给正文留出空间
+            if len(msg_title) > max_title:
+                msg_title = msg_title[:max_title - 1] + "…"
             try:
-                msg_title = xml.xpath('/msg/appmsg/title/text()')[0]
-            except:
-                msg_title = ""
-            try:
-                recorditem_element = xml.find('.//recorditem')
-                inner_xml_string = recorditem_element.text
-                recordinfo_root = etree.fromstring(inner_xml_string.encode('utf-8'))
-                texts = []
-                for data in parse_chat_history(recordinfo_root):
-                    texts.append(data['formatted'])
-                forward_content = "\n".join(texts)
+                max_chars = max(CHAT_HISTORY_MAX_CHARS - len(msg_title) - 16, 256)
+                chunks = list(split_lines(render_chat_history(required(app.recorditem)), max_chars)) or [""]
             except Exception as e:
-                forward_content = xml.xpath('/msg/appmsg/des/text()')[0]
+                chunks = [required(app.des)]
 
-            result_text += f"{msg_title}\n\n{forward_content}"
-            efb_msg = Message(
-                type=MsgType.Text,
-                text= result_text,
-                vendor_specific={ "is_forwarded": True }
-            )
+            efb_msg = []
+            for i, chunk in enumerate(chunks):
+                header = f"{msg_title} ({i + 1}/{len(chunks)})" if len(chunks) > 1 else msg_title
+                efb_msg.append(Message(
+                    type=MsgType.Text,
+                    text= f"{header}\n\n{chunk}",
+                    vendor_specific={ "is_forwarded": True }
+                ))
+            if len(efb_msg) == 1:
+                efb_msg = efb_msg[0]
         elif type == 21: # 微信运动
-            msg_title = xml.xpath('/msg/appmsg/title/text()')[0].strip("<![CDATA[夺得").strip("冠军]]>")
+            msg_title = required(app.title).strip("<![CDATA[夺得").strip("冠军]]>")
             if '排行' not in msg_title:
                 msg_title = msg_title.strip()
                 efb_msg = Message(
@@ -388,8 +428,8 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                     text= msg_title ,
                 )
             else:
-                rank = xml.xpath('/msg/appmsg/hardwareinfo/messagenodeinfo/rankinfo/rank/rankdisplay/text()')[0].strip("<![CDATA[").strip("]]>")
-                steps = xml.xpath('/msg/appmsg/hardwareinfo/messagenodeinfo/rankinfo/score/scoredisplay/text()')[0].strip("<![CDATA[").strip("]]>")
+                rank = XPATH_SPORT_RANK(xml)[0].strip("<![CDATA[").strip("]]>")
+                steps = XPATH_SPORT_SCORE(xml)[0].strip("<![CDATA[").strip("]]>")
                 result_text += f"{msg_title}\n\n排名: {rank}\n步数: {steps}"
                 efb_msg = Message(
                     type=MsgType.Text,
@@ -397,19 +437,18 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                     vendor_specific={ "is_wechatsport": True }
                 )
         elif type == 24:
-            desc = xml.xpath('/msg/appmsg/des/text()')[0]
-            recorditem = xml.xpath('/msg/appmsg/recorditem/text()')[0]
-            xml = etree.fromstring(recorditem)
-            datadesc = xml.xpath('/recordinfo/datalist/dataitem/datadesc/text()')[0]
+            desc = required(app.des)
+            recorditem = parse_xml(required(app.recorditem))
+            datadesc = XPATH_RECORD_DATADESC(recorditem)[0]
             efb_msg = Message(
                 type=MsgType.Text,
                 text= '微信笔记 :\n  - - - - - - - - - - - - - - - \n' +desc + '\n' + datadesc,
                 vendor_specific={ "is_mp": True }
             )
         elif type == 33:
-            sourcedisplayname = xml.xpath('/msg/appmsg/sourcedisplayname/text()')[0]
-            weappiconurl = xml.xpath('/msg/appmsg/weappinfo/weappiconurl/text()')[0]
-            url = xml.xpath('/msg/appmsg/url/text()')[0]
+            sourcedisplayname = required(app.sourcedisplayname)
+            weappiconurl = XPATH_WEAPP_ICON_URL(xml)[0]
+            url = required(app.url)
             attribute = LinkAttribute(
                 title=sourcedisplayname,
                 description=None,
@@ -429,24 +468,20 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                 vendor_specific={ "is_mp": False }
             )
         elif type == 40: # 转发的转发消息
-            title = xml.xpath('/msg/appmsg/title/text()')[0]
-            desc = xml.xpath('/msg/appmsg/des/text()')[0]
+            title = required(app.title)
+            desc = required(app.des)
             efb_msg = Message(
                 type=MsgType.Text,
                 text= f"{title}\n\n{desc}" ,
                 vendor_specific={ "is_forwarded": True }
             )
         elif type == 51: # 视频（微信视频号分享）
-            title = xml.xpath('/msg/appmsg/title/text()')[0]
-            url = xml.xpath('/msg/appmsg/url/text()')[0]
-            if len(xml.xpath('/msg/appmsg/finderFeed/avatar/text()'))!=0:
-                imgurl = xml.xpath('/msg/appmsg/finderFeed/avatar/text()')[0].strip("<![CDATA[").strip("]]>")
-            else:
-                imgurl = None
-            if len(xml.xpath('/msg/appmsg/finderFeed/desc/text()'))!=0:
-                desc = xml.xpath('/msg/appmsg/finderFeed/desc/text()')[0]
-            else:
-                desc = None
+            title = required(app.title)
+            url = required(app.url)
+            imgurl = first(XPATH_FINDER_FEED_AVATAR, xml)
+            if imgurl is not None:
+                imgurl = imgurl.strip("<![CDATA[").strip("]]>")
+            desc = first(XPATH_FINDER_FEED_DESC, xml)
             result_text += f"微信视频号分享\n - - - - - - - - - - - - - - - \n"
             attribute = LinkAttribute(
                 title=title,
@@ -461,16 +496,13 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                 vendor_specific={ "is_mp": True }
             )
         elif type == 57: # 引用（回复）消息
-            msg = xml.xpath('/msg/appmsg/title/text()')[0]
-            refer_msgType = int(xml.xpath('/msg/appmsg/refermsg/type/text()')[0]) # 被引用消息类型
-            e = xml.xpath('/msg/appmsg/refermsg/svrid/text()') # 被引用消息 id
-            refer_svrid = len(e) > 0 and e[0] or None
-            e = xml.xpath('/msg/appmsg/refermsg/fromusr/text()') # 被引用消息所在房间
-            refer_fromusr = len(e) > 0 and e[0] or None
-            e = xml.xpath('/msg/appmsg/refermsg/chatusr/text()') # 被引用消息发送人微信号
-            refer_chatusr = len(e) > 0 and e[0] or None
-            e = xml.xpath('/msg/appmsg/refermsg/displayname/text()') # 被引用消息发送人微信名称
-            refer_displayname = len(e) > 0 and e[0] or refer_chatusr
+            refer = required(app.refermsg)
+            msg = convert_wc_emoticons(required(app.title))
+            refer_msgType = required(refer.type) # 被引用消息类型
+            refer_svrid = refer.svrid # 被引用消息 id
+            refer_fromusr = refer.fromusr # 被引用消息所在房间
+            refer_chatusr = refer.chatusr # 被引用消息发送人微信号
+            refer_displayname = refer.displayname or refer_chatusr # 被引用消息发送人微信名称
             efb_msg = Message(
                 type=MsgType.Text,
                 text=msg,
@@ -490,16 +522,13 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                 prefix = f"{refer_displayname}:"
             if refer_svrid is None or (refer_chatusr == message["self"] and sent_by_master):
                 if refer_msgType == 1: # 被引用的消息是文本
-                    refer_content = xml.xpath('/msg/appmsg/refermsg/content/text()')[0] # 被引用消息内容
+                    refer_content = convert_wc_emoticons(required(refer.content)) # 被引用消息内容
                     result_text = qutoed_text(refer_content, msg, prefix)
                 elif refer_msgType == 49: # 被引用的消息也是引用消息
                     try:
-                        refer_msg_content = xml.xpath('/msg/appmsg/refermsg/content/text()')[0] # 被引用消息引用的消息
-                        refer_msg_xml = etree.fromstring(refer_msg_content)
-                        type = int(refer_msg_xml.xpath('/msg/appmsg/type/text()')[0])
-                        if type == 57:
-                            refer_msg_text = refer_msg_xml.xpath('/msg/appmsg/title/text()')[0]
-                            result_text = qutoed_text(refer_msg_text, msg, prefix)
+                        refer_app = AppMsg.parse(parse_xml(required(refer.content))) # 被引用消息引用的消息
+                        if refer_app.type == 57:
+                            result_text = qutoed_text(required(refer_app.title), msg, prefix)
                         else:
                             result_text = msg
                     except Exception as e:
@@ -513,10 +542,10 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
                     chat=chat,
                 )
         elif type == 63: # 直播（微信视频号分享）
-            title = xml.xpath('/msg/appmsg/title/text()')[0]
-            url = xml.xpath('/msg/appmsg/url/text()')[0]
-            imgurl = xml.xpath('/msg/appmsg/finderLive/headUrl/text()')[0].strip("<![CDATA[").strip("]]>")
-            desc = xml.xpath('/msg/appmsg/finderLive/desc/text()')[0].strip("<![CDATA[").strip("]]>")
+            title = required(app.title)
+            url = required(app.url)
+            imgurl = XPATH_FINDER_LIVE_HEAD_URL(xml)[0].strip("<![CDATA[").strip("]]>")
+            desc = XPATH_FINDER_LIVE_DESC(xml)[0].strip("<![CDATA[").strip("]]>")
             result_text += f"视频号直播分享\n  - - - - - - - - - - - - - - - \n"
             attribute = LinkAttribute(
                 title=title,
@@ -539,8 +568,8 @@ def efb_share_link_wrapper(message: dict, chat) -> Message:
         #         vendor_specific={ "is_mp": False }
         #     )
         elif type == 2000:
-            subtype = xml.xpath("/msg/appmsg/wcpayinfo/paysubtype/text()")[0]
-            money =  xml.xpath("/msg/appmsg/wcpayinfo/feedesc/text()")[0].strip("<![CDATA[").strip("]]>")
+            subtype = XPATH_PAY_SUBTYPE(xml)[0]
+            money =  XPATH_PAY_FEEDESC(xml)[0].strip("<![CDATA[").strip("]]>")
             if subtype == "1":
                 efb_msg = Message(
                     type=MsgType.Text,
@@ -583,7 +612,10 @@ def efb_location_wrapper(msg: str) -> Message:
     return efb_msg
 
 def efb_qqmail_wrapper(text: str) -> Message:
-    xml = etree.fromstring(text)
+    try:
+        xml = parse_xml(text)
+    except XmlLimitExceeded:
+        return efb_text_simple_wrapper(OVERSIZE_PLACEHOLDER)
     result_text = ""
     sender = xml.xpath('/msg/pushmail/content/sender/text()')[0].strip("<![CDATA[").strip("]]>")
     subjectwithCDATA = xml.xpath('/msg/pushmail/content/subject/text()')
@@ -608,7 +640,10 @@ def efb_qqmail_wrapper(text: str) -> Message:
     return efb_msg
 
 def efb_miniprogram_wrapper(text: str) -> Message:
-    xml = etree.fromstring(text)
+    try:
+        xml = parse_xml(text)
+    except XmlLimitExceeded:
+        return efb_text_simple_wrapper(OVERSIZE_PLACEHOLDER)
     result_text = ""
     title = xml.xpath('/msg/appmsg/title/text()')[0]
     programname = xml.xpath('/msg/appmsg/sourcedisplayname/text()')[0]
@@ -673,7 +708,10 @@ def efb_other_wrapper(text: str, chat) -> Union[Message, None]:
     :return: EFB Message or None
     """
 
-    xml = etree.fromstring(text)
+    try:
+        xml = parse_xml(text)
+    except XmlLimitExceeded:
+        return efb_text_simple_wrapper(OVERSIZE_PLACEHOLDER)
     efb_msg = None
     try:
         msg_type = xml.xpath('/sysmsg/@type')[0]
@@ -12,15 +12,22 @@ from lxml import etree
 from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.message import Message
 
-def MsgWrapper(msg, efb_msgs:  Union[Message, List[Message]]):
+def MsgWrapper(msg, efb_msgs:  Union[Message, List[Message]], slim: bool = False):
+    """
+    :param slim: 只附带消息索引的引用键和类型，原始 xml 和回调字段由 MessageIndex 保存
+    """
     efb_msgs = [efb_msgs] if isinstance(efb_msgs, Message) else efb_msgs
     if not efb_msgs:
         return
     for efb_msg in efb_msgs:
         vendor_specific = getattr(efb_msg, "vendor_specific", {})
-        xml = msg.pop("message", None)
-        vendor_specific["wx_xml"] = xml
-        vendor_specific["comwechat_info"] = msg
+        if slim:
+            vendor_specific["wx_ref"] = str(msg["msgid"])
+            vendor_specific["wx_type"] = msg["type"]
+        else:
+            xml = msg.pop("message", None)
+            vendor_specific["wx_xml"] = xml
+            vendor_specific["comwechat_info"] = msg
         setattr(efb_msg, "vendor_specific", vendor_specific)
     return efb_msgs
 
@@ -51,7 +58,7 @@ def MsgProcess(msg : dict , chat) -> Union[Message, List[Message]]:
         return efb_text_simple_wrapper("[" + msg['message'] + "]")
 
     elif msg["type"] == "image":
-        file = wechatimagedecode(msg["filepath"])
+        file = load_wechat_image(msg["filepath"])
         return efb_image_wrapper(file)
 
     elif msg["type"] == "animatedsticker":
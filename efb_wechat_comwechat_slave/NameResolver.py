@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class NameResolver:
+    """
+    不在联系人列表中的 wxid 的名称解析缓存
+    查到的名称和查不到的结果分别按不同 TTL 缓存；同一 wxid 的并发查询只发起一次，
+    短时间内到达的多个未知 wxid 合并为一次查询
+    """
+
+    def __init__(self, fetch: Callable[[List[str]], Dict[str, str]],
+                 positive_ttl: float = 3600, negative_ttl: float = 300,
+                 maxsize: int = 10000, batch_window: float = 0.05, timeout: float = 10):
+        """
+        :param fetch: 批量查询函数 fetch([wxid, ...]) -> {wxid : name}，查不到的 wxid 不出现在结果中
+        :param positive_ttl: 查到名称时的缓存时间（秒）
+        :param negative_ttl: 查不到名称时的缓存时间（秒）
+        :param maxsize: 最大缓存条数
+        :param batch_window: 合并查询的等待时间（秒）
+        :param timeout: 等待其他线程查询结果的最长时间（秒）
+        """
+        self.fetch = fetch
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.batch_window = batch_window
+        self.timeout = timeout
+
+        self.cache: LRUCache = LRUCache(maxsize=maxsize)   # {wxid : (name, expires)}
+        self.inflight: Dict[str, threading.Event] = {}
+        self.pending: List[str] = []
+        self.collecting = False
+        self.lock = threading.Lock()
+
+    def resolve(self, wxid: str) -> Optional[str]:
+        """
+        :return: 名称，查不到时返回 None
+        """
+        with self.lock:
+            cached = self._cached(wxid)
+            if cached is not None:
+                return cached[0]
+            event = self.inflight.get(wxid)
+            leader = False
+            if event is None:
+                event = self.inflight[wxid] = threading.Event()
+                self.pending.append(wxid)
+                if not self.collecting:
+                    self.collecting = leader = True
+
+        if leader:
+            self._run_batch()
+        event.wait(self.timeout)
+
+        with self.lock:
+            cached = self._cached(wxid)
+        return cached[0] if cached is not None else None
+
+    def invalidate(self, wxid: str):
+        with self.lock:
+            self.cache.pop(wxid, None)
+
+    def _cached(self, wxid: str):
+        cached = self.cache.get(wxid)
+        if cached is not None and cached[1] < time.monotonic():
+            del self.cache[wxid]
+            return None
+        return cached
+
+    def _run_batch(self):
+        time.sleep(self.batch_window)
+        with self.lock:
+            batch, self.pending = self.pending, []
+            self.collecting = False
+
+        failed = False
+        try:
+            names = self.fetch(batch) or {}
+        except Exception as e:
+            logger.warning(f"Failed to resolve names of {batch}. {e}")
+            names, failed = {}, True
+
+        now = time.monotonic()
+        with self.lock:
+            for wxid in batch:
+                name = names.get(wxid)
+                if name:
+                    self.cache[wxid] = (name, now + self.positive_ttl)
+                elif not failed:
+                    self.cache[wxid] = (None, now + self.negative_ttl)
+                event = self.inflight.pop(wxid, None)
+                if event is not None:
+                    event.set()
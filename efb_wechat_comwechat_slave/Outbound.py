@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from .Dispatcher import ChatDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    令牌桶限速，全账号共享，避免短时间内大量发送触发微信风控
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 5):
+        """
+        :param rate: 每秒补充的令牌数，为 0 时不限速
+        :param burst: 桶容量，即允许连续发送的条数
+        """
+        self.lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float = 1.0, burst: int = 5):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(int(burst), 1)
+            self.tokens = float(self.burst)
+            self.updated = time.monotonic()
+
+    def acquire(self) -> float:
+        """
+        取一个令牌，不足时阻塞等待
+        :return: 等待的秒数
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return waited
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    请求确定没有送达机器人的错误（连接被拒绝、连接超时），重试不会重复发送
+    读响应时断开等情况下消息可能已发出，不视为可重试
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class OutboundQueue:
+    """
+    发往微信的消息队列
+    master 线程只负责入队；同一聊天的消息按 FIFO 顺序在工作线程上发送，所有机器人调用经过共享的令牌桶限速，
+    暂时性错误原样重试，最终失败通过 on_failure 异步通知
+    """
+
+    def __init__(self, on_failure: Callable[[str, Any, Exception], None], workers: int = 2, queue_size: int = 1000,
+                 rate: float = 1.0, burst: int = 5, retries: int = 3, backoff: float = 1.0):
+        """
+        :param on_failure: 发送失败回调 (chat_uid, msg, exception)
+        :param workers: 工作线程数，为 0 时在 master 线程上同步发送
+        :param queue_size: 每个分片队列的最大长度
+        :param rate: 每秒允许的机器人发送调用数
+        :param burst: 允许连续发送的调用数
+        :param retries: 暂时性错误的最大重试次数
+        :param backoff: 首次重试前的基础等待时间（秒）
+        """
+        self.on_failure = on_failure
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        self.dispatcher = ChatDispatcher(workers = workers, queue_size = queue_size, name = "outbound")
+        self.timings: Dict[str, List[float]] = {}    # {func : [count, failures, retries, total seconds]}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.dispatcher.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+
+    def submit(self, chat_uid: str, job: Callable[[Any], Any], msg: Any):
+        """
+        将 job(msg) 放入聊天对应的队列，立即返回
+        """
+        self.dispatcher.submit(chat_uid, self._run, chat_uid, job, msg)
+
+    def call(self, func: Callable[..., Any], **kwargs) -> Any:
+        """
+        限速调用机器人接口，暂时性错误按指数退避加抖动重试
+        须在 job 中调用
+        """
+        name = getattr(func, "__name__", str(func))
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            begin = time.monotonic()
+            try:
+                result = func(**kwargs)
+            except Exception as e:
+                retry = is_transient(e) and attempt < self.retries
+                self._record(name, begin, failed = True, retried = retry)
+                if not retry:
+                    raise
+                attempt += 1
+                logger.warning(f"Transient error when calling {name}, retry {attempt}/{self.retries}. {e}")
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            else:
+                self._record(name, begin)
+                return result
+
+    def pending(self) -> int:
+        return self.dispatcher.pending()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = {
+                name: {"count": count, "failures": failures, "retries": retries, "avg": total / count if count else 0.0}
+                for name, (count, failures, retries, total) in self.timings.items()
+            }
+        return {"pending": self.pending(), "calls": calls}
+
+    def _run(self, chat_uid: str, job: Callable[[Any], Any], msg: Any):
+        try:
+            job(msg)
+        except Exception as e:
+            logger.exception(f"Failed to send message to {chat_uid}")
+            try:
+                self.on_failure(chat_uid, msg, e)
+            except Exception:
+                logger.exception("Error occurred when reporting send failure")
+
+    def _record(self, name: str, begin: float, failed: bool = False, retried: bool = False):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0, 0, 0.0])
+            timing[0] += 1
+            timing[1] += 1 if failed else 0
+            timing[2] += 1 if retried else 0
+            timing[3] += time.monotonic() - begin
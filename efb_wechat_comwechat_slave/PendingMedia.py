@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+FILE = "file"
+DELETE = "delete"
+
+
+class PendingMediaTracker:
+    """
+    跟踪等待 WeChat 下载完成的媒体文件，以及待删除的临时文件
+    按截止时间堆调度检查，检查间隔指数退避；安装了 inotify_simple 时，文件写入完成会立即唤醒对应条目
+    """
+
+    def __init__(self, time_out: int,
+                 on_ready: Callable[[Any, bool], None],
+                 probe: Optional[Callable[[str, Any], bool]] = None,
+                 min_interval: float = 0.5,
+                 max_interval: float = 5):
+        """
+        :param time_out: 等待文件出现以及延迟删除文件的秒数
+        :param on_ready: 文件就绪或等待超时时的回调 on_ready(item, timed_out)
+        :param probe: 文件不存在时的额外检查 probe(path, item)，返回 True 视为就绪
+        :param min_interval: 首次重试间隔
+        :param max_interval: 最大重试间隔
+        """
+        self.time_out = time_out
+        self.on_ready = on_ready
+        self.probe = probe
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.file_msg: Dict[str, List] = {}       # {path : [item, deadline, interval, next_check]}
+        self.delete_file: Dict[str, float] = {}   # {path : delete_at}
+
+        self._heap: List[Tuple[float, int, str, str]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+        self._inotify = None
+        self._watches: Dict[str, int] = {}        # {dir : wd}
+        self._watch_dirs: Dict[int, str] = {}     # {wd : dir}
+        if INotify is not None:
+            try:
+                self._inotify = INotify()
+            except OSError as e:
+                logger.warning(f"inotify unavailable, falling back to polling. {e}")
+
+    def add(self, path: str, item: Any):
+        """
+        登记一个等待下载的文件
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.file_msg[path] = [item, now + self.time_out, self.min_interval, now]
+            self._push(now, FILE, path)
+            self._watch(os.path.dirname(path))
+
+    def delete_later(self, path: str, delay: Optional[float] = None):
+        """
+        在 delay 秒（默认 time_out）后删除文件
+        """
+        when = time.monotonic() + (self.time_out if delay is None else delay)
+        with self._cond:
+            self.delete_file[path] = when
+            self._push(when, DELETE, path)
+
+    def wake(self, path: str):
+        """
+        立即重新检查某个等待中的文件
+        """
+        now = time.monotonic()
+        with self._cond:
+            entry = self.file_msg.get(path)
+            if entry is None:
+                return
+            entry[3] = now
+            self._push(now, FILE, path)
+
+    def run(self):
+        if self._inotify is not None:
+            t = threading.Thread(target=self._watch_loop, name="pending-media-inotify")
+            t.daemon = True
+            t.start()
+        while True:
+            for kind, path in self._wait_due():
+                try:
+                    if kind == FILE:
+                        self._check(path)
+                    else:
+                        self._delete(path)
+                except Exception:
+                    logger.exception(f"Error occurred when processing pending {kind} {path}")
+
+    def _push(self, when: float, kind: str, path: str):
+        heapq.heappush(self._heap, (when, next(self._seq), kind, path))
+        self._cond.notify()
+
+    def _wait_due(self) -> List[Tuple[str, str]]:
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                break
+            now = time.monotonic()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                when, _, kind, path = heapq.heappop(self._heap)
+                if kind == FILE:
+                    entry = self.file_msg.get(path)
+                    if entry is None or entry[3] != when:
+                        continue    # 条目已处理或已被重新调度
+                elif self.delete_file.get(path) != when:
+                    continue
+                due.append((kind, path))
+            return due
+
+    def _check(self, path: str):
+        with self._cond:
+            entry = self.file_msg.get(path)
+            if entry is None:
+                return
+            item, deadline = entry[0], entry[1]
+
+        timed_out = False
+        if os.path.exists(path):
+            ready = True
+        elif time.monotonic() > deadline:
+            ready = timed_out = True
+        else:
+            try:
+                ready = bool(self.probe and self.probe(path, item))
+            except Exception as e:
+                logger.warning(f"Error occurred when probing {path}. {e}")
+                ready = False
+
+        with self._cond:
+            if ready:
+                self.file_msg.pop(path, None)
+                self._unwatch(os.path.dirname(path))
+            else:
+                interval = entry[2]
+                entry[2] = min(interval * 2, self.max_interval)
+                entry[3] = min(time.monotonic() + interval, deadline + 0.1)
+                self._push(entry[3], FILE, path)
+                return
+        self.on_ready(item, timed_out)
+
+    def _delete(self, path: str):
+        with self._cond:
+            self.delete_file.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _watch(self, directory: str):
+        if self._inotify is None or directory in self._watches or not os.path.isdir(directory):
+            return
+        try:
+            wd = self._inotify.add_watch(directory, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        except OSError as e:
+            logger.debug(f"Failed to watch {directory}. {e}")
+            return
+        self._watches[directory] = wd
+        self._watch_dirs[wd] = directory
+
+    def _unwatch(self, directory: str):
+        if directory not in self._watches:
+            return
+        if any(os.path.dirname(path) == directory for path in self.file_msg):
+            return
+        wd = self._watches.pop(directory)
+        self._watch_dirs.pop(wd, None)
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            pass
+
+    def _watch_loop(self):
+        while True:
+            try:
+                events = self._inotify.read()
+            except OSError as e:
+                logger.warning(f"inotify read failed, falling back to polling. {e}")
+                return
+            for event in events:
+                directory = self._watch_dirs.get(event.wd)
+                if directory and event.name:
+                    self.wake(os.path.join(directory, event.name))
@@ -0,0 +1,144 @@
+import itertools
+import threading
+from typing import Iterator, Tuple, Union
+
+from lxml import etree
+
+
+class XmlLimitExceeded(ValueError):
+    """
+    xml 超出字节数、嵌套深度或节点数限制
+    """
+
+
+class SafeXmlParser:
+    """
+    解析不可信的消息 xml
+    不解析实体、不加载 DTD、不访问网络；先检查字节数，解析时分块喂入并统计嵌套深度和节点数，超限立即中止。
+    每个线程复用一个解析器
+    """
+
+    def __init__(self, max_bytes: int = 1024 * 1024, max_depth: int = 64, max_nodes: int = 100000,
+                 chunk_size: int = 64 * 1024):
+        """
+        :param max_bytes: 最大字节数（UTF-8）
+        :param max_depth: 最大嵌套深度
+        :param max_nodes: 最大元素数
+        :param chunk_size: 每次喂入解析器的字节数，即超限后最多多解析的数据量
+        """
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        self.configure(max_bytes, max_depth, max_nodes)
+
+    def configure(self, max_bytes: int = 1024 * 1024, max_depth: int = 64, max_nodes: int = 100000):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+
+    def parse(self, text: Union[str, bytes]):
+        """
+        :return: 根节点
+        :raise XmlLimitExceeded: 超出限制
+        :raise etree.XMLSyntaxError: xml 格式错误
+        """
+        root = None
+        for _, element in self._events(self._parser(), text):
+            if root is None:
+                root = element
+        return root
+
+    def iter_elements(self, text: Union[str, bytes], tag: str) -> Iterator:
+        """
+        增量解析，依次产出最外层的 tag 元素（不在另一个 tag 元素内）
+        产出的元素在下一次迭代前被清空以释放内存；提前停止迭代时剩余数据不再解析。
+        使用独立的解析器，迭代过程中仍可调用 parse
+        """
+        open_tags = 0
+        for event, element in self._events(self._new_parser(), text):
+            if element.tag != tag:
+                continue
+            if event == "start":
+                open_tags += 1
+                continue
+            open_tags -= 1
+            if open_tags == 0:
+                yield element
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    def _events(self, parser: etree.XMLPullParser, text: Union[str, bytes]) -> Iterator[Tuple[str, etree._Element]]:
+        data = text.encode("utf-8") if isinstance(text, str) else text
+        if len(data) > self.max_bytes:
+            raise XmlLimitExceeded(f"xml is {len(data)} bytes, limit is {self.max_bytes}")
+
+        depth = nodes = 0
+        chunks = (data[offset:offset + self.chunk_size] for offset in range(0, len(data), self.chunk_size))
+        try:
+            for chunk in itertools.chain(chunks, (None,)):
+                if chunk is None:
+                    parser.close()
+                else:
+                    parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == "start":
+                        depth += 1
+                        nodes += 1
+                        if depth > self.max_depth:
+                            raise XmlLimitExceeded(f"xml is nested deeper than {self.max_depth}")
+                        if nodes > self.max_nodes:
+                            raise XmlLimitExceeded(f"xml has more than {self.max_nodes} elements")
+                    else:
+                        depth -= 1
+                    yield event, element
+        except etree.XMLSyntaxError as e:
+            self._reset(parser)
+            if e.code == etree.ErrorTypes.ERR_RESOURCE_LIMIT:     # libxml2 自身的深度、实体展开等限制
+                raise XmlLimitExceeded(str(e)) from e
+            raise
+        except BaseException:       # 包括提前停止迭代时的 GeneratorExit
+            self._reset(parser)
+            raise
+
+    def _parser(self) -> etree.XMLPullParser:
+        parser = getattr(self.local, "parser", None)
+        if parser is None:
+            parser = self.local.parser = self._new_parser()
+        return parser
+
+    @staticmethod
+    def _new_parser() -> etree.XMLPullParser:
+        return etree.XMLPullParser(
+            events=("start", "end"),
+            resolve_entities=False,
+            load_dtd=False,
+            no_network=True,
+            huge_tree=False,
+        )
+
+    @staticmethod
+    def _reset(parser: etree.XMLPullParser):
+        # 中止或出错的解析器需 close 并清空未读事件后才能继续复用
+        try:
+            parser.close()
+        except Exception:
+            pass
+        for _ in parser.read_events():
+            pass
+
+
+xml_parser = SafeXmlParser()
+
+
+def parse_xml(text: Union[str, bytes]):
+    """
+    用共享的解析器解析不可信的消息 xml
+    """
+    return xml_parser.parse(text)
+
+
+def iter_xml_elements(text: Union[str, bytes], tag: str) -> Iterator:
+    """
+    按共享的限制增量解析不可信的消息 xml，依次产出最外层的 tag 元素
+    """
+    return xml_parser.iter_elements(text, tag)
@@ -0,0 +1,117 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, name: str, func: Callable[[], Optional[bool]], interval: float,
+                 jitter: float = 0.1, max_interval: Optional[float] = None, backoff: float = 1.5):
+        """
+        :param name: 任务名
+        :param func: 任务函数，返回 False 表示本次没有变化，下次间隔按 backoff 延长，直至 max_interval
+        :param interval: 基础间隔（秒）
+        :param jitter: 间隔的随机抖动比例
+        :param max_interval: 无变化时最长间隔，默认为 interval（不退避）
+        :param backoff: 无变化时的间隔倍数
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.max_interval = max(max_interval or interval, interval)
+        self.backoff = backoff
+
+        self.current_interval = interval
+        self.next_run = time.monotonic()
+        self.last_run: Optional[float] = None         # time.time()
+        self.last_duration: Optional[float] = None
+        self.runs = 0
+        self.failures = 0
+        self.running = False
+        self.rerun = False
+
+    def schedule(self, delay: float):
+        self.next_run = time.monotonic() + delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def __str__(self):
+        last_run = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_run)) if self.last_run else "never"
+        duration = f"{self.last_duration:.2f}s" if self.last_duration is not None else "-"
+        next_in = max(self.next_run - time.monotonic(), 0)
+        return (f"{self.name}: last run {last_run} ({duration}), runs {self.runs}, failures {self.failures}, "
+                f"interval {self.current_interval:.0f}s, next in {next_in:.0f}s")
+
+
+class Scheduler:
+    """
+    周期任务调度器，每个任务有独立的间隔、抖动和运行统计，可手动立即运行或提前运行
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self.cond = threading.Condition()
+
+    def add_job(self, name: str, func: Callable[[], Optional[bool]], interval: float, **kwargs) -> Job:
+        job = Job(name, func, interval, **kwargs)
+        with self.cond:
+            self.jobs[name] = job
+            self.cond.notify()
+        return job
+
+    def run_now(self, name: str) -> bool:
+        return self.hasten(name, 0)
+
+    def hasten(self, name: str, delay: float) -> bool:
+        """
+        使任务最迟在 delay 秒后运行，并恢复基础间隔
+        """
+        with self.cond:
+            job = self.jobs.get(name)
+            if job is None:
+                return False
+            job.current_interval = job.interval
+            job.next_run = min(job.next_run, time.monotonic() + delay)
+            job.rerun = job.running
+            self.cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    due = [job for job in self.jobs.values() if job.next_run <= now]
+                    if due:
+                        break
+                    timeout = min((job.next_run for job in self.jobs.values()), default=now + 60) - now
+                    self.cond.wait(timeout)
+            for job in due:
+                self._execute(job)
+
+    def _execute(self, job: Job):
+        job.running = True
+        begin = time.monotonic()
+        changed = None
+        try:
+            changed = job.func()
+        except Exception:
+            job.failures += 1
+            logger.exception(f"Error occurred when running scheduled job {job.name}")
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_run = time.time()
+            job.last_duration = time.monotonic() - begin
+
+        with self.cond:
+            if changed is False:
+                job.current_interval = min(job.current_interval * job.backoff, job.max_interval)
+            else:
+                job.current_interval = job.interval
+            job.schedule(job.current_interval)
+            if job.rerun:
+                job.rerun = False
+                job.next_run = time.monotonic()
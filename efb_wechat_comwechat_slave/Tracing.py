@@ -0,0 +1,260 @@
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    一条消息的处理过程，spans 为 (名称, 相对开始的秒数, 耗时, 嵌套深度)
+    state 为 running、suspending、suspended、resumed 或 expired，由当时持有追踪的一方负责结束
+    """
+    __slots__ = ("msgid", "attrs", "begin", "wall", "spans", "state", "suspended_at")
+
+    def __init__(self, msgid: str, attrs: Dict[str, Any]):
+        self.msgid = msgid
+        self.attrs = attrs
+        self.begin = time.monotonic()
+        self.wall = time.time()
+        self.spans: List[Tuple[str, float, float, int]] = []
+        self.state = "running"
+        self.suspended_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "msgid": self.msgid,
+            "time": self.wall,
+            "attrs": self.attrs,
+            "total": time.monotonic() - self.begin,
+            "spans": [
+                {"name": name, "start": start, "duration": duration, "depth": depth}
+                for name, start, duration, depth in sorted(self.spans, key=lambda span: (span[1], span[3]))
+            ],
+        }
+
+
+class Tracer:
+    """
+    按 msgid 抽样记录消息各处理阶段的耗时，完成后作为一行 JSON 写入按大小轮转的文件
+    当前线程正在处理的消息保存在线程局部变量中，span 和 traced 无需传入 msgid；未抽样时几乎没有开销。
+    等待文件下载的消息先 suspend，之后在其他线程上 resume 继续记录；长时间未 resume 的由 expire 结束
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.path: Optional[str] = None
+        self.writer: Optional[logging.Logger] = None
+        self.max_active = 10000
+        self.max_recent = 1000
+        self.active: OrderedDict = OrderedDict()     # {msgid : Trace}，进行中（含等待文件）的消息
+        self.recent: OrderedDict = OrderedDict()     # {msgid : dict}，最近完成的消息
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def configure(self, path: Optional[str], sample_rate: float = 0.0, max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 3):
+        """
+        :param path: JSONL 文件路径，为 None 时只保留在内存中
+        :param sample_rate: 抽样比例，0 为关闭
+        :param max_bytes: 单个文件的最大字节数
+        :param backup_count: 保留的轮转文件数
+        """
+        self.sample_rate = sample_rate
+        self.path = path
+        writer = logging.getLogger(f"{__name__}.spans")
+        writer.propagate = False
+        writer.setLevel(logging.INFO)
+        for handler in list(writer.handlers):
+            writer.removeHandler(handler)
+            handler.close()
+        if path and sample_rate > 0:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                           encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            writer.addHandler(handler)
+            self.writer = writer
+        else:
+            self.writer = None
+
+    @contextlib.contextmanager
+    def trace(self, msgid, name: str, **attrs):
+        """
+        按抽样比例开始追踪一条消息，并把 name 记为最外层的 span
+        退出时若消息未被 suspend 则结束追踪，否则转入等待
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield
+            return
+        trace = Trace(str(msgid), attrs)
+        with self.lock:
+            self.active[trace.msgid] = trace
+            while len(self.active) > self.max_active:
+                self.active.popitem(last=False)
+        try:
+            with self._current(trace), self.span(name):
+                yield
+        finally:
+            with self.lock:
+                suspended = trace.state == "suspending"
+                if suspended:
+                    trace.suspended_at = time.monotonic()
+                    trace.state = "suspended"
+            if not suspended:
+                self._finish(trace)
+
+    def suspend(self):
+        """
+        当前消息在 trace 退出时转入等待，之后由 resume 继续
+        须在 trace 退出之后再交给其他线程，否则 resume 时最外层的 span 尚未记录
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1][0].state = "suspending"
+
+    @contextlib.contextmanager
+    def resume(self, msgid, name: str, wait: str = "pending_wait", **attrs):
+        """
+        在当前线程上继续追踪被 suspend 的消息，等待时间记为 wait，退出时结束追踪
+        """
+        with self.lock:
+            trace = self.active.get(str(msgid))
+            if trace is None or trace.state != "suspended":
+                trace = None
+            else:
+                trace.state = "resumed"
+        if trace is None:
+            yield
+            return
+        now = time.monotonic()
+        trace.spans.append((wait, trace.suspended_at - trace.begin, now - trace.suspended_at, 0))
+        trace.attrs.update(attrs)
+        try:
+            with self._current(trace), self.span(name):
+                yield
+        finally:
+            if trace.state == "resumed":
+                self._finish(trace)
+
+    def expire(self, max_age: float) -> bool:
+        """
+        结束等待超过 max_age 秒仍未 resume 的消息（如等待的条目被丢弃），供 Scheduler 定期调用
+        :return: 是否结束了记录
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [trace for trace in self.active.values()
+                       if trace.state == "suspended" and now - trace.suspended_at >= max_age]
+            for trace in expired:
+                trace.state = "expired"
+        for trace in expired:
+            trace.spans.append(("pending_wait", trace.suspended_at - trace.begin, now - trace.suspended_at, 0))
+            trace.attrs["expired"] = True
+            self._finish(trace)
+        return bool(expired)
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        stack = getattr(self.local, "stack", None)
+        if not stack:
+            yield
+            return
+        trace, depth = stack[-1]
+        begin = time.monotonic()
+        stack.append((trace, depth + 1))
+        try:
+            yield
+        finally:
+            stack.pop()
+            trace.spans.append((name, begin - trace.begin, time.monotonic() - begin, depth))
+
+    def traced(self, name: Optional[str] = None) -> Callable:
+        """
+        装饰器，把函数调用记为当前消息的 span
+        """
+        def deco(func: Callable) -> Callable:
+            span_name = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return deco
+
+    def get(self, msgid) -> Optional[Dict[str, Any]]:
+        """
+        查找消息的追踪记录，依次查找进行中、最近完成和 JSONL 文件中的记录
+        """
+        msgid = str(msgid)
+        with self.lock:
+            trace = self.active.get(msgid)
+            if trace is not None:
+                record = trace.to_dict()
+                record["in_progress"] = True
+                return record
+            if msgid in self.recent:
+                return self.recent[msgid]
+        return self._search(msgid)
+
+    @staticmethod
+    def format(record: Dict[str, Any]) -> str:
+        attrs = " ".join(f"{k}={v}" for k, v in record.get("attrs", {}).items())
+        state = "（进行中）" if record.get("in_progress") else ""
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+        head = " ".join(part for part in (record["msgid"], attrs, when) if part)
+        lines = [f"{head} 共 {record['total']:.3f}s{state}"]
+        for span in record["spans"]:
+            indent = "  " * span["depth"]
+            lines.append(f"{indent}{span['name']}: {span['duration']:.3f}s (+{span['start']:.3f}s)")
+        return "\n".join(lines)
+
+    @contextlib.contextmanager
+    def _current(self, trace: Trace):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append((trace, 0))
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def _finish(self, trace: Trace):
+        record = trace.to_dict()
+        with self.lock:
+            if self.active.get(trace.msgid) is trace:
+                del self.active[trace.msgid]
+            self.recent[trace.msgid] = record
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+        if self.writer is not None:
+            self.writer.info(json.dumps(record, ensure_ascii=False))
+
+    def _search(self, msgid: str) -> Optional[Dict[str, Any]]:
+        if not self.path:
+            return None
+        needle = f'"msgid": {json.dumps(msgid)}'
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, 100)]
+        for path in paths:
+            if not os.path.exists(path):
+                break
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        if needle in line:
+                            return json.loads(line)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to search trace file {path}. {e}")
+        return None
+
+
+tracer = Tracer()
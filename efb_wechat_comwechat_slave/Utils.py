@@ -2,13 +2,26 @@ import logging
 import tempfile
 import threading
 import requests as requests
+import requests.adapters
+import random
+import time
 import re
 import json
 import yaml
-from typing import Dict , Any
+from typing import Dict , Any , List , Optional , Tuple , BinaryIO
 import pilk
 import pydub
+import pydub.exceptions
+import subprocess
 import os
+import io
+import contextlib
+import mmap
+import shutil
+import uuid
+
+from .MediaPool import media_pool
+from .Tracing import tracer
 
 #从本地读取配置
 def load_config(path : str) -> Dict[str, None]:
@@ -25,99 +38,345 @@ def load_config(path : str) -> Dict[str, None]:
         config: Dict[str, Any] = d
     return config
 
+class Downloader:
+    """
+    共享的 HTTP 下载器
+    复用 keep-alive 连接池，限制全局并发数，失败时按指数退避加抖动重试，服务器支持时用 Range 断点续传
+    """
+
+    def __init__(self, max_concurrency: int = 8, pool_size: int = 16, chunk_size: int = 256 * 1024,
+                 timeout: float = 10, backoff: float = 0.5):
+        """
+        :param max_concurrency: 同时进行的下载数上限
+        :param pool_size: 每个 host 保持的连接数
+        :param chunk_size: 读取块大小
+        :param timeout: 连接和读取超时（秒）
+        :param backoff: 首次重试前的基础等待时间（秒）
+        """
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.backoff = backoff
+        self.configure(max_concurrency, pool_size)
+
+    def configure(self, max_concurrency: int = 8, pool_size: int = 16):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.session = session
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def download(self, url: str, retry: int = 3) -> tempfile:
+        """
+        A function that downloads files from given URL
+        Remember to close the file once you are done with the file!
+        :param retry: The max retries before giving up
+        :param url: The URL that points to the file
+        """
+        file = tempfile.NamedTemporaryFile()
+        resumable = False
+        count = 1
+        with self.semaphore:
+            while True:
+                offset = file.tell() if resumable else 0
+                try:
+                    headers = {"Range": f"bytes={offset}-"} if offset else {}
+                    with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            file.seek(0)
+                            file.truncate()
+                        resumable = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            if chunk:
+                                file.write(chunk)
+                except Exception as e:
+                    status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+                    if status == 416:
+                        resumable = False           # 续传位置无效，下次从头下载
+                    elif status is not None and status < 500:
+                        file.close()
+                        raise e
+                    logging.getLogger(__name__).warning(f"Error occurred when downloading {url}. {e}")
+                    if count >= retry:
+                        logging.getLogger(__name__).warning(f"Maximum retry reached. Giving up.")
+                        file.close()
+                        raise e
+                    time.sleep(self.backoff * 2 ** (count - 1) * random.uniform(0.5, 1.5))
+                    count += 1
+                else:
+                    break
+        file.flush()
+        file.seek(0)
+        return file
+
+downloader = Downloader()
+
+@tracer.traced()
 def download_file(url: str, retry: int = 3) -> tempfile:
     """
-    A function that downloads files from given URL
+    A function that downloads files from given URL with the shared downloader
     Remember to close the file once you are done with the file!
     :param retry: The max retries before giving up
     :param url: The URL that points to the file
     """
-    count = 1
-    while True:
+    return downloader.download(url, retry)
+
+# 微信 .dat 图片为原图逐字节异或同一个 key，根据文件头特征反推 key
+# (格式, ((偏移, 特征字节), ...))
+WECHAT_IMAGE_SIGNATURES = (
+    ('jpg', ((0, b'\xff\xd8\xff'),)),
+    ('png', ((0, b'\x89PNG'),)),
+    ('gif', ((0, b'GIF8'),)),
+    ('webp', ((0, b'RIFF'), (8, b'WEBP'))),
+    ('heic', ((4, b'ftypheic'),)),
+    ('heic', ((4, b'ftypheix'),)),
+    ('heic', ((4, b'ftypmif1'),)),
+    ('bmp', ((0, b'BM'),)),
+)
+WECHAT_IMAGE_CHUNK_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def guess_wechat_image_encoding(header : bytes) -> Optional[Tuple[str, int]]:
+    """
+    根据 .dat 文件头推断图片格式和异或 key
+    :return: (格式, key)，无法识别时返回 None
+    """
+    for encoding, signatures in WECHAT_IMAGE_SIGNATURES:
+        offset, signature = signatures[0]
+        if len(header) < offset + len(signature):
+            continue
+        magic = header[offset] ^ signature[0]
+        if all(
+            len(header) >= offset + len(signature)
+            and all(header[offset + i] ^ magic == b for i, b in enumerate(signature))
+            for offset, signature in signatures
+        ):
+            return encoding, magic
+    return None
+
+def wechatimagedecode( file : str, out_path : str) -> None:
+    """
+    解码微信 .dat 图片到 out_path，在媒体进程池中运行
+    按块内存映射读取，用 bytes.translate 查表异或后直接写入 out_path
+    out_path 由调用方创建并负责删除，这里只打开已有文件；调用方超时放弃后删除了文件时不会重新创建
+    思路来源 https://github.com/zhangxiaoyang/WechatImageDecoder
+    """
+    with open(out_path, 'r+b') as ret_file:
+        with open(file , 'rb') as f:
+            header = f.read(16)
+            guess = guess_wechat_image_encoding(header)
+            if guess is None:
+                raise ValueError(f"Unknown WeChat image format: {file}")
+            file_type, magic = guess
+            table = bytes(b ^ magic for b in range(256))
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for offset in range(0, size, WECHAT_IMAGE_CHUNK_SIZE):
+                        ret_file.write(mm[offset:offset + WECHAT_IMAGE_CHUNK_SIZE].translate(table))
+
+def load_wechat_image(file : str) -> 'LinkedTempFile':
+    """
+    在媒体进程池中解码微信 .dat 图片
+    :return: 解码后的临时文件，关闭时删除；解码失败或超时时删除临时文件
+    """
+    with tempfile.NamedTemporaryFile(prefix="comwechat-", delete=False) as out:
+        pass
+    try:
+        media_pool.run("image", wechatimagedecode, file, out.name)
+        return LinkedTempFile(out.name)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(out.name)
+        raise
+
+class LinkedTempFile(io.BufferedReader):
+    """
+    关闭时删除的只读临时文件，用于硬链接（原文件不受影响）或媒体进程池写出的文件
+    """
+
+    def __init__(self, path : str):
+        super().__init__(io.FileIO(path, 'rb'))
+
+    def close(self):
+        if self.closed:
+            return
         try:
-            file = tempfile.NamedTemporaryFile()
-            r = requests.get(url, stream=True, timeout=10)
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    file.write(chunk)
-                    file.flush()
-        except Exception as e:
-            logging.getLogger(__name__).warning(f"Error occurred when downloading {url}. {e}")
-            if count >= retry:
-                logging.getLogger(__name__).warning(f"Maximum retry reached. Giving up.")
-                raise e
-            count += 1
-        else:
-            break
-    return file
-
-def wechatimagedecode( file : str) -> tempfile:
-    """
-    代码来源 https://github.com/zhangxiaoyang/WechatImageDecoder
-    """
-    def do_magic(header_code, buf):
-        return header_code ^ list(buf)[0] if buf else 0x00
-    
-    def decode(magic, buf):
-        return bytearray([b ^ magic for b in list(buf)])
-
-    def guess_encoding(buf):
-        headers = {
-            'jpg': (0xff, 0xd8),
-            'png': (0x89, 0x50),
-            'gif': (0x47, 0x49),
-        }
-        for encoding in headers:
-            header_code, check_code = headers[encoding] 
-            magic = do_magic(header_code, buf)
-            _, code = decode(magic, buf[:2])
-            if check_code == code:
-                return (encoding, magic)
-        return None
+            super().close()
+        finally:
+            try:
+                os.unlink(self.name)
+            except OSError:
+                pass
 
-    with open(file , 'rb') as f:
-        buf = bytearray(f.read())
-    file_type, magic = guess_encoding(buf)
+def stream_copy(src : BinaryIO, dst : BinaryIO) -> None:
+    """
+    在内核中复制文件内容，优先 copy_file_range，其次 sendfile，都不可用时分块复制
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    size = os.fstat(src_fd).st_size
+    offset = 0
+    try:
+        while offset < size:
+            if hasattr(os, "copy_file_range"):
+                sent = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+            else:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+    except OSError:
+        src.seek(offset)
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    dst.flush()
 
+@tracer.traced()
+def load_local_file_to_temp(file : str) -> BinaryIO:
+    """
+    从本地文件读取文件到临时文件
+    优先在临时目录中创建硬链接，不复制数据；跨文件系统等无法链接时流式复制，内存占用与文件大小无关
+    """
+    link = os.path.join(tempfile.gettempdir(), f"comwechat-{uuid.uuid4().hex}")
+    try:
+        os.link(file, link)
+        return LinkedTempFile(link)
+    except OSError:
+        pass
     ret_file = tempfile.NamedTemporaryFile()
-    with open(ret_file.name , 'wb') as f:
-        f.write(decode(magic, buf))
-    f.close()
+    with open(file , 'rb') as f:
+        stream_copy(f, ret_file)
+    ret_file.seek(0)
     return ret_file
 
-def load_local_file_to_temp(file : str) -> tempfile:
+def pin_temp_file(file : BinaryIO) -> BinaryIO:
     """
-    从本地文件读取文件到临时文件
+    为调用方随后会关闭并删除的文件建立自有的只读副本，关闭时删除
+    原文件仍在时在临时目录中硬链接，否则从已打开的文件流式复制
     """
+    source = getattr(file, "name", None)
+    link = os.path.join(tempfile.gettempdir(), f"comwechat-{uuid.uuid4().hex}")
+    try:
+        if isinstance(source, str) and os.path.samestat(os.stat(source), os.fstat(file.fileno())):
+            os.link(source, link)
+            return LinkedTempFile(link)
+    except OSError:
+        pass
     ret_file = tempfile.NamedTemporaryFile()
-    with open(file , 'rb') as f:
-        ret_file.write(f.read())
-    f.close()
+    stream_copy(file, ret_file)
+    ret_file.seek(0)
     return ret_file
 
-def load_temp_file_to_local(file : tempfile , path : str) -> None:
+def decode_silk(silk_path : str, sample_rate : int = 24000) -> bytes:
+    """
+    将 SILK 解码为 PCM，在媒体进程池中运行
+    """
+    if not hasattr(os, "memfd_create"):
+        with tempfile.NamedTemporaryFile() as f:
+            pilk.decode(silk_path, f.name, pcm_rate=sample_rate)
+            return f.read()
+    fd = os.memfd_create("silk-pcm")
+    try:
+        pilk.decode(silk_path, f"/proc/self/fd/{fd}", pcm_rate=sample_rate)
+        return os.pread(fd, os.fstat(fd).st_size, 0)
+    finally:
+        os.close(fd)
+
+def export_ogg_as_mp3(src : str, dst : str) -> None:
+    """
+    将 master 发来的 ogg 语音转为 mp3，在媒体进程池中运行
+    """
+    pydub.AudioSegment.from_ogg(src).export(dst, format="mp3")
+
+class VoiceTranscoder:
     """
-    从临时文件写到本地
+    SILK 语音转 OGG/Opus
+    SILK 在内存中解码为 PCM，经管道交给预先启动的 ffmpeg 编码并直接写入结果文件；
+    每取走一个 ffmpeg 就补充一个，进程启动不计入转码耗时，全程没有中间文件
     """
-    with open(path , 'wb') as f:
-        f.write(file.read())
-    f.close()
 
+    def __init__(self, sample_rate: int = 24000, warm_workers: int = 1, timeout: float = 60):
+        """
+        :param sample_rate: 解码 PCM 的采样率
+        :param warm_workers: 预先启动待命的 ffmpeg 数量
+        :param timeout: 单条语音编码超时（秒）
+        """
+        self.sample_rate = sample_rate
+        self.warm_workers = warm_workers
+        self.timeout = timeout
+        self.workers: List[Tuple[subprocess.Popen, BinaryIO]] = []
+        self.lock = threading.Lock()
+
+    def configure(self, warm_workers: int = 1):
+        self.warm_workers = warm_workers
+
+    def transcode(self, silk_path: str) -> tempfile:
+        """
+        Remember to close the file once you are done with the file!
+        """
+        return self.encode(self.decode(silk_path))
+
+    def decode(self, silk_path: str) -> bytes:
+        return media_pool.run("silk", decode_silk, silk_path, self.sample_rate)
+
+    def encode(self, pcm: bytes) -> tempfile:
+        proc, file = self._take()
+        try:
+            _, err = proc.communicate(pcm, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            file.close()
+            raise pydub.exceptions.CouldntEncodeError(f"Encoding voice timed out after {self.timeout}s")
+        if proc.returncode != 0:
+            file.close()
+            raise pydub.exceptions.CouldntEncodeError(err.decode(errors="ignore"))
+        file.seek(0)
+        return file
+
+    def _take(self) -> Tuple[subprocess.Popen, BinaryIO]:
+        with self.lock:
+            worker = None
+            while self.workers and worker is None:
+                proc, file = self.workers.pop(0)
+                if proc.poll() is None:
+                    worker = proc, file
+                else:
+                    file.close()
+            if worker is None:
+                worker = self._spawn()
+            while len(self.workers) < self.warm_workers:
+                self.workers.append(self._spawn())
+        return worker
+
+    def _spawn(self) -> Tuple[subprocess.Popen, BinaryIO]:
+        file = tempfile.NamedTemporaryFile()
+        proc = subprocess.Popen(
+            [pydub.AudioSegment.converter, "-hide_banner", "-loglevel", "error",
+             "-f", "s16le", "-ar", str(self.sample_rate), "-ac", "1", "-i", "pipe:0",
+             "-c:a", "libopus", "-vbr", "on", "-f", "ogg", "pipe:1"],
+            stdin=subprocess.PIPE, stdout=file, stderr=subprocess.PIPE,
+        )
+        return proc, file
+
+voice_transcoder = VoiceTranscoder()
+
+@tracer.traced()
 def convert_silk_to_mp3(file : tempfile) -> tempfile:
     """
-    将silk文件转换为mp3文件
+    将silk文件转换为ogg(opus)文件，非silk文件原样返回
     """
-    f = tempfile.NamedTemporaryFile()
     file.seek(0)
     silk_header = file.read(10)
     file.seek(0)
-    if b"#!SILK_V3" in silk_header:
-        pilk.decode(file.name, f.name)
+    if b"#!SILK_V3" not in silk_header:
+        return file
+    try:
+        return voice_transcoder.transcode(file.name)
+    finally:
         file.close()
-        pydub.AudioSegment.from_raw(file= f , sample_width=2, frame_rate=24000, channels=1) \
-            .export( f , format="ogg", codec="libopus",
-                    parameters=['-vbr', 'on'])
-    return f
 
 
 WC_EMOTICON_CONVERSION = {
@@ -245,3 +504,16 @@ WC_EMOTICON_CONVERSION = {
     '[生病]': '😷', '[Sick]': '😷',
     '[笑脸]': '😁', '[Happy]': '😁',
 }
+
+# 按长度降序拼接，保证较长的表情代码优先匹配
+WC_EMOTICON_PATTERN = re.compile("|".join(
+    re.escape(emoticon) for emoticon in sorted(WC_EMOTICON_CONVERSION, key=len, reverse=True)
+))
+
+def convert_wc_emoticons(text : str) -> str:
+    """
+    单次扫描将微信表情代码替换为 emoji
+    """
+    if not text or "[" not in text:
+        return text
+    return WC_EMOTICON_PATTERN.sub(lambda match: WC_EMOTICON_CONVERSION[match.group(0)], text)
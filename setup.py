@@ -35,6 +35,9 @@ setup(
         "lottie",
         "cairosvg",
     ],
+    extras_require={
+        "inotify": ["inotify_simple"],
+    },
     long_description=long_description,
     long_description_content_type="text/markdown",
     classifiers=[
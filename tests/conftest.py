@@ -0,0 +1,57 @@
+import sys
+import types
+
+import pytest
+
+try:
+    import pyzbar.pyzbar  # noqa: F401
+except ImportError:         # 没有 zbar 动态库时，ComWechat 的导入会失败；初始化用不到二维码识别
+    pyzbar = types.ModuleType("pyzbar")
+    pyzbar.pyzbar = types.ModuleType("pyzbar.pyzbar")
+    pyzbar.pyzbar.decode = lambda image: []
+    sys.modules.setdefault("pyzbar", pyzbar)
+    sys.modules.setdefault("pyzbar.pyzbar", pyzbar.pyzbar)
+
+from efb_wechat_comwechat_slave import ComWechat
+
+
+class FakeRobot:
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, *event_types):
+        def deco(func):
+            for event_type in event_types:
+                self.handlers.setdefault(event_type, []).append(func)
+            return func
+        return deco
+
+    def IsLoginIn(self):
+        return {"is_login": 1}
+
+    def GetSelfInfo(self):
+        return {"data": {"wxId": "wxid_self"}}
+
+    def get_base_path(self):
+        return "C:\\WeChat Files"
+
+
+@pytest.fixture
+def channel_config():
+    """
+    测试可覆盖的频道配置
+    """
+    return {}
+
+
+@pytest.fixture
+def channel(tmp_path, monkeypatch, channel_config):
+    (tmp_path / "wxid_self").mkdir()
+    monkeypatch.setattr(ComWechat, "WeChatRobot", FakeRobot)
+    monkeypatch.setattr(ComWechat, "load_config", lambda path: {"dir": str(tmp_path), **channel_config})
+    monkeypatch.setattr(ComWechat.efb_utils, "get_config_path", lambda channel_id: tmp_path / "config.yaml")
+    monkeypatch.setattr(ComWechat.efb_utils, "get_data_path", lambda channel_id: tmp_path)
+    channel = ComWechat.ComWeChatChannel()
+    yield channel
+    channel.outbound.stop()
+    channel.dispatcher.stop()
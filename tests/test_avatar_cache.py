@@ -0,0 +1,27 @@
+import tempfile
+
+from efb_wechat_comwechat_slave import AvatarCache as avatar_cache
+from efb_wechat_comwechat_slave.AvatarCache import AvatarCache
+
+
+def used_at(cache, wxid):
+    return cache.db.execute("SELECT used_at FROM avatars WHERE wxid = ?", (wxid,)).fetchone()[0]
+
+
+def test_hits_are_flushed_in_batches(tmp_path, monkeypatch):
+    def download_file(url):
+        file = tempfile.TemporaryFile()
+        file.write(url.encode())
+        file.seek(0)
+        return file
+
+    monkeypatch.setattr(avatar_cache, "download_file", download_file)
+    cache = AvatarCache(tmp_path, lambda wxid: f"http://avatar/{wxid}")
+    assert cache.get("alice").read() == b"http://avatar/alice"
+    saved = used_at(cache, "alice")
+
+    assert cache.get("alice").read() == b"http://avatar/alice"
+    assert used_at(cache, "alice") == saved
+    assert cache.flush()
+    assert used_at(cache, "alice") > saved
+    assert not cache.flush()
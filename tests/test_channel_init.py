@@ -0,0 +1,46 @@
+from efb_wechat_comwechat_slave import ComWechat
+from efb_wechat_comwechat_slave.Metrics import metrics
+
+
+def test_init_wires_subsystems(channel):
+    assert channel.wxid == "wxid_self"
+    assert isinstance(channel.bot.api, ComWechat.MeteredApi)
+    for event in ("self_msg", "friend_msg", "group_msg", "revoke_msg", "transfer_msg", "frdver_msg"):
+        assert event in channel.bot.handlers
+
+
+def test_init_registers_readable_gauges(channel):
+    text = metrics.render()
+    for name in ("comwechat_outbound_pending", "comwechat_dispatch_pending", "comwechat_pending_files",
+                 "comwechat_pending_deletes", "comwechat_dedupe_hit_ratio", "comwechat_seconds_since_last_callback"):
+        assert f"# TYPE {name} gauge" in text
+
+
+def contact(nickname, contact_type=3, remark=""):
+    return {"remark": remark, "nickname": nickname, "type": contact_type}
+
+
+def test_contact_tables_are_per_instance_and_replaced_on_refresh(channel, monkeypatch):
+    monkeypatch.setattr(ComWechat.coordinator, "master", None, raising=False)
+    assert "friends" not in vars(ComWechat.ComWeChatChannel)
+    channel.bot.GetContactListBySql = lambda: {"alice": contact("Alice"), "team@chatroom": contact("Team", 2)}
+    assert channel.GetContactListBySql()
+    friends, groups = channel.friends, channel.groups
+    assert set(friends) == {"alice"} and set(groups) == {"team@chatroom"}
+
+    channel.bot.GetContactListBySql = lambda: {"bob": contact("Bob"), "team@chatroom": contact("Team", 2)}
+    assert channel.GetContactListBySql()
+    assert set(friends) == {"alice"}        # 正在被其他线程遍历的旧表保持不变
+    assert set(channel.friends) == {"bob"}
+    assert channel.contacts == {"bob": "Bob", "team@chatroom": "Team"}
+    assert not channel.GetContactListBySql()
+
+
+def test_chat_registry_fits_all_contacts(channel, monkeypatch):
+    monkeypatch.setattr(ComWechat.coordinator, "master", None, raising=False)
+    monkeypatch.setattr(ComWechat.ChatMgr, "cache_size", ComWechat.ChatMgr.cache_size)
+    contacts = {f"wxid_{i}": contact(f"Friend {i}") for i in range(channel.chat_cache_size + 100)}
+    channel.bot.GetContactListBySql = lambda: contacts
+    channel.GetContactListBySql()
+    assert ComWechat.ChatMgr.cache_size >= len(contacts)
+    assert any(uid == "wxid_0" for _, uid in ComWechat.ChatMgr.registry)     # 最早构建的会话没有被淘汰
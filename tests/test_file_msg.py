@@ -0,0 +1,25 @@
+import threading
+from types import SimpleNamespace
+
+
+def test_ready_files_are_handled_on_the_chat_dispatcher(channel):
+    gate = threading.Event()
+    handled = []
+
+    def handle_file_msg(item, timed_out):
+        gate.wait(5)
+        handled.append((item[0]["msgid"], timed_out, threading.current_thread().name))
+
+    channel.handle_file_msg = handle_file_msg
+    channel.dispatcher.start()
+    chat = SimpleNamespace(uid="friend")
+    for msgid in range(3):
+        channel.pending_media.on_ready(({"msgid": msgid}, None, chat), msgid == 2)
+    assert handled == []        # 跟踪线程没有被阻塞
+
+    gate.set()
+    done = threading.Event()
+    channel.dispatcher.submit(chat.uid, done.set)
+    assert done.wait(5)
+    assert [(msgid, timed_out) for msgid, timed_out, _ in handled] == [(0, False), (1, False), (2, True)]
+    assert all(name.startswith("dispatcher") for _, _, name in handled)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+
+from efb_wechat_comwechat_slave.MediaStaging import MediaStager
+from efb_wechat_comwechat_slave.Metrics import metrics
+
+
+def make_file(data):
+    file = tempfile.TemporaryFile()
+    file.write(data)
+    file.seek(0)
+    return file
+
+
+def test_same_name_is_staged_separately(tmp_path):
+    stager = MediaStager(str(tmp_path))
+    first = stager.stage(make_file(b"first"), "report.pdf")
+    second = stager.stage(make_file(b"second"), "report.pdf")
+
+    assert first != second
+    assert os.path.basename(first) == os.path.basename(second) == "report.pdf"
+    with open(first, "rb") as f:
+        assert f.read() == b"first"
+    with open(second, "rb") as f:
+        assert f.read() == b"second"
+
+    os.remove(first)
+    stager.stage(make_file(b"third"), "other.pdf")
+    assert not os.path.exists(os.path.dirname(first))
+    assert stager.used == len(b"second") + len(b"third")
+
+
+def observed(stage):
+    counts = metrics.histograms.get("comwechat_outbound_media_seconds", {}).get((("stage", stage),))
+    return (sum(counts[:-1]), counts[-1]) if counts else (0, 0.0)
+
+
+def test_stage_timings_are_reported(tmp_path):
+    stager = MediaStager(str(tmp_path))
+    count, total = observed("transcode")
+    with stager.timed("transcode"):
+        time.sleep(0.05)
+    stager.stage(make_file(b"data"), "a.jpg")
+
+    stats = stager.stats()
+    assert stats["stages"]["transcode"]["count"] == 1
+    assert stats["stages"]["transcode"]["last"] >= 0.05
+    assert stats["stages"]["stage"]["count"] == 1
+    assert stats["used"] == 4 and stats["files"] == 1
+    new_count, new_total = observed("transcode")
+    assert new_count == count + 1
+    assert new_total - total >= 0.05
+    assert 'comwechat_outbound_media_seconds_count{stage="stage"}' in metrics.render()
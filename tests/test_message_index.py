@@ -0,0 +1,36 @@
+import os
+import time
+
+from efb_wechat_comwechat_slave.MessageIndex import MessageIndex
+
+
+def record(index, msgid, xml="<msg/>", pinned=False):
+    index.record(msgid, "chat", "author", "Author", "share", "Link", f"text {msgid}", xml, pinned=pinned)
+
+
+def test_oversize_xml_is_limited_after_compression(tmp_path):
+    index = MessageIndex(str(tmp_path / "messages.sqlite"), hot_size=0, max_xml=1024)
+    compressible = "<msg>" + "a" * 100000 + "</msg>"
+    record(index, "1", compressible)
+    record(index, "2", os.urandom(4096).hex())
+    assert index.get("1").xml == compressible
+    entry = index.get("2")
+    assert entry.xml is None
+    assert entry.text == "text 2"
+
+
+def test_pinned_messages_outlive_ttl_until_pinned_ttl(tmp_path):
+    index = MessageIndex(str(tmp_path / "messages.sqlite"), ttl=60, hot_size=0, pinned_ttl=600)
+    record(index, "1")
+    record(index, "2", pinned=True)
+    record(index, "3", pinned=True)
+    now = time.time()
+    index.db.execute("UPDATE messages SET ts = ? WHERE msgid IN ('1', '2')", (now - 120,))
+    index.db.execute("UPDATE messages SET ts = ? WHERE msgid = '3'", (now - 1200,))
+    index.db.commit()
+
+    assert "1" not in index
+    assert index.get("2").pinned
+    assert "3" not in index
+    assert index.compact()
+    assert index.db.execute("SELECT msgid FROM messages").fetchall() == [("2",)]
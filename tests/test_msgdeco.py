@@ -0,0 +1,47 @@
+from xml.sax.saxutils import escape
+
+import pytest
+
+from efb_wechat_comwechat_slave.MsgDeco import (CHAT_HISTORY_MAX_CHARS, configure_chat_history, efb_share_link_wrapper,
+                                                render_chat_history, split_lines)
+
+
+@pytest.fixture
+def chat_history_limits():
+    yield configure_chat_history
+    configure_chat_history()
+
+
+def test_chat_history_converts_emoticons():
+    recorditem = (
+        "<recordinfo><datalist>"
+        "<dataitem datatype=\"1\"><sourcename>Alice</sourcename><datadesc>好的[OK]</datadesc></dataitem>"
+        "<dataitem datatype=\"5\"><sourcename>Bob</sourcename><datatitle>[Smile]链接</datatitle></dataitem>"
+        "</datalist></recordinfo>"
+    )
+    lines = list(render_chat_history(recorditem))
+    assert lines == ["Alice:  好的👌", "Bob:  [Link] 😃链接"]
+
+
+def test_chat_history_limits_are_configurable(chat_history_limits):
+    recorditem = "<recordinfo><datalist>" + "".join(
+        f"<dataitem datatype=\"1\"><sourcename>A</sourcename><datadesc>{i}</datadesc></dataitem>" for i in range(5)
+    ) + "</datalist></recordinfo>"
+    chat_history_limits(max_items=2)
+    assert list(render_chat_history(recorditem)) == ["A:  0", "A:  1", "…… 其余聊天记录未展示，请在手机端查看"]
+
+
+def test_split_lines_rejects_non_positive_width():
+    with pytest.raises(ValueError):
+        list(split_lines(["abc"], 0))
+
+
+def test_chat_history_with_oversized_title():
+    recorditem = escape("<recordinfo><datalist>"
+                        "<dataitem datatype=\"1\"><sourcename>A</sourcename><datadesc>hello</datadesc></dataitem>"
+                        "</datalist></recordinfo>")
+    xml = (f"<msg><appmsg><type>19</type><title>{'t' * 3990}</title><des>desc</des>"
+           f"<recorditem>{recorditem}</recorditem></appmsg></msg>")
+    efb_msg = efb_share_link_wrapper({"message": xml}, None)
+    assert len(efb_msg.text) <= CHAT_HISTORY_MAX_CHARS
+    assert efb_msg.text.endswith("A:  hello")
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from ehforwarderbot import MsgType
+
+from efb_wechat_comwechat_slave.Outbound import OutboundQueue, is_transient
+
+
+class FakeBot:
+    """
+    按预设依次抛出异常，之后返回成功
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def SendText(self, **kwargs):
+        with self.lock:
+            self.calls.append((time.monotonic(), kwargs))
+            if self.errors:
+                raise self.errors.pop(0)
+        return {"msg": 1}
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def failures():
+    return []
+
+
+@pytest.fixture
+def make_queue(failures):
+    queues = []
+
+    def make(**kwargs):
+        kwargs.setdefault("backoff", 0.01)
+        queue = OutboundQueue(lambda chat_uid, msg, e: failures.append((chat_uid, msg, e)), **kwargs)
+        queue.start()
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.stop()
+
+
+def connect_timeout():
+    return requests.exceptions.ConnectTimeout("connect timed out")
+
+
+def test_fifo_per_chat(make_queue):
+    queue = make_queue(workers=4, rate=0)
+    bot = FakeBot()
+    for chat in ("a", "b", "c"):
+        for i in range(50):
+            queue.submit(chat, lambda msg: queue.call(bot.SendText, wxid=msg[0], msg=msg[1]), (chat, i))
+    wait_for(lambda: len(bot.calls) == 150)
+    for chat in ("a", "b", "c"):
+        assert [kwargs["msg"] for _, kwargs in bot.calls if kwargs["wxid"] == chat] == list(range(50))
+
+
+def test_token_bucket_paces_calls(make_queue):
+    queue = make_queue(workers=2, rate=20, burst=2)
+    bot = FakeBot()
+    begin = time.monotonic()
+    for i in range(10):
+        queue.submit(f"chat{i}", lambda msg: queue.call(bot.SendText, wxid=msg, msg=""), f"chat{i}")
+    wait_for(lambda: len(bot.calls) == 10)
+    # 2 条突发，其余 8 条按每秒 20 条补充
+    assert bot.calls[-1][0] - begin >= 8 / 20 * 0.9
+    assert bot.calls[1][0] - begin < 0.1
+
+
+def test_retries_connect_timeout(make_queue, failures):
+    queue = make_queue(workers=1, rate=0, retries=3)
+    bot = FakeBot([connect_timeout(), connect_timeout()])
+    queue.submit("a", lambda msg: queue.call(bot.SendText, wxid="a", msg=msg), "hello")
+    wait_for(lambda: len(bot.calls) == 3)
+    time.sleep(0.05)
+    assert len(bot.calls) == 3
+    assert failures == []
+    assert queue.stats()["calls"]["SendText"]["retries"] == 2
+
+
+def test_does_not_retry_read_timeout(make_queue, failures):
+    queue = make_queue(workers=1, rate=0, retries=3)
+    bot = FakeBot([requests.exceptions.ReadTimeout("read timed out")])
+    queue.submit("a", lambda msg: queue.call(bot.SendText, wxid="a", msg=msg), "hello")
+    wait_for(lambda: failures)
+    assert len(bot.calls) == 1
+    chat_uid, msg, e = failures[0]
+    assert (chat_uid, msg) == ("a", "hello")
+    assert isinstance(e, requests.exceptions.ReadTimeout)
+
+
+def test_gives_up_after_retries(make_queue, failures):
+    queue = make_queue(workers=1, rate=0, retries=2)
+    bot = FakeBot([connect_timeout() for _ in range(5)])
+    queue.submit("a", lambda msg: queue.call(bot.SendText, wxid="a", msg=msg), "hello")
+    wait_for(lambda: failures)
+    assert len(bot.calls) == 3
+    assert isinstance(failures[0][2], requests.exceptions.ConnectTimeout)
+
+
+def test_is_transient():
+    refused = requests.exceptions.ConnectionError(
+        requests.packages.urllib3.exceptions.MaxRetryError(
+            None, "/", requests.packages.urllib3.exceptions.NewConnectionError(None, "refused")))
+    assert is_transient(connect_timeout())
+    assert is_transient(refused)
+    assert not is_transient(requests.exceptions.ReadTimeout())
+    assert not is_transient(requests.exceptions.ConnectionError("connection aborted"))
+    assert not is_transient(ValueError())
+
+
+@pytest.mark.parametrize("channel_config", [{"send_workers": 1, "send_rate": 0}])
+def test_send_message_survives_master_closing_file(channel, failures):
+    sent = []
+
+    def send_image(receiver, img_path):
+        prefix = f"{channel.base_path}\\{channel.wxid}\\"
+        assert img_path.startswith(prefix)
+        parts = img_path[len(prefix):].split("\\")
+        name = parts[-1]
+        with open(os.path.join(channel.stager.directory, *parts), "rb") as f:
+            sent.append((receiver, name, f.read()))
+        return {"msg": 1}
+
+    channel.bot.SendImage = send_image
+    channel.report_send_failure = lambda chat_uid, msg, e: failures.append(e)
+    channel.outbound.on_failure = channel.report_send_failure
+    channel.outbound.start()
+
+    gate = threading.Event()
+    channel.outbound.submit("friend", lambda msg: gate.wait(5), None)     # 让发送排在 master 关闭文件之后
+
+    file = tempfile.NamedTemporaryFile(suffix=".jpg")
+    file.write(b"image data")
+    file.flush()
+    file.seek(0)
+    msg = SimpleNamespace(chat=SimpleNamespace(uid="friend"), type=MsgType.Image, file=file, filename=None,
+                          text="", edit=False, target=None)
+    channel.send_message(msg)
+    file.close()            # efb-telegram-master 在 send_message 返回后关闭并删除文件
+    gate.set()
+
+    wait_for(lambda: sent or failures)
+    assert failures == []
+    assert sent == [("friend", os.path.basename(file.name), b"image data")]
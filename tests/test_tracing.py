@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+from efb_wechat_comwechat_slave.Tracing import Tracer
+
+
+@pytest.fixture
+def tracer():
+    tracer = Tracer()
+    tracer.configure(None, sample_rate=1.0)
+    return tracer
+
+
+def span_names(record):
+    return [span["name"] for span in record["spans"]]
+
+
+def test_suspended_trace_keeps_outer_span(tracer):
+    with tracer.trace("1", "handle_msg"):
+        with tracer.span("prepare"):
+            pass
+        tracer.suspend()
+        assert tracer.get("1")["in_progress"]
+
+    def resume():
+        with tracer.resume("1", "handle_file_msg"):
+            with tracer.span("MsgProcess"):
+                pass
+    t = threading.Thread(target=resume)
+    t.start()
+    t.join()
+
+    record = tracer.get("1")
+    assert "in_progress" not in record
+    assert span_names(record) == ["handle_msg", "prepare", "pending_wait", "handle_file_msg", "MsgProcess"]
+
+
+def test_resume_before_trace_exits_is_ignored(tracer):
+    with tracer.trace("1", "handle_msg"):
+        tracer.suspend()
+        with tracer.resume("1", "handle_file_msg"):
+            pass
+    assert tracer.get("1")["in_progress"]
+
+
+def test_expire_finishes_abandoned_traces(tracer):
+    with tracer.trace("1", "handle_msg"):
+        tracer.suspend()
+    assert not tracer.expire(60)
+    assert tracer.expire(0)
+
+    record = tracer.get("1")
+    assert "in_progress" not in record
+    assert record["attrs"]["expired"] is True
+    assert span_names(record) == ["handle_msg", "pending_wait"]
+    with tracer.resume("1", "handle_file_msg"):
+        pass
+    assert span_names(tracer.get("1")) == ["handle_msg", "pending_wait"]
@@ -0,0 +1,51 @@
+import concurrent.futures
+import os
+import tempfile
+
+import pytest
+
+from efb_wechat_comwechat_slave import Utils
+
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 60 + b"\xff\xd9"
+
+
+@pytest.fixture
+def dat_file(tmp_path):
+    path = tmp_path / "image.dat"
+    path.write_bytes(bytes(b ^ 0x37 for b in JPEG))
+    return str(path)
+
+
+@pytest.fixture
+def temp_files():
+    def list_files():
+        return {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("comwechat-")}
+    before = list_files()
+    return lambda: list_files() - before
+
+
+def test_load_wechat_image(dat_file, temp_files, monkeypatch):
+    monkeypatch.setattr(Utils.media_pool, "workers", 0)
+    file = Utils.load_wechat_image(dat_file)
+    assert file.read() == JPEG
+    file.close()
+    assert not temp_files()
+
+
+def test_timed_out_decode_leaves_no_file(dat_file, temp_files, monkeypatch):
+    late = []
+
+    def run(task, func, *args, **kwargs):
+        late.append((func, args))
+        raise concurrent.futures.TimeoutError()
+
+    monkeypatch.setattr(Utils.media_pool, "run", run)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        Utils.load_wechat_image(dat_file)
+    assert not temp_files()
+
+    func, args = late[0]            # 子进程中的任务在调用方放弃之后才执行
+    with pytest.raises(FileNotFoundError):
+        func(*args)
+    assert not temp_files()